@@ -0,0 +1,282 @@
+import sys, os, shutil, subprocess, json, time, argparse, struct, hashlib, random
+from zipfile import ZipFile
+
+# Benchmark for build_from_mm.py that doesn't need the real game or OpenKH.
+# Generates a synthetic KH2 install (.pkg/.hed pairs), a Mods Manager `mod` tree, a pkgmap and some .kh2pcpatch archives,
+# then runs build_from_mm.main(cli_args=[...]) for every requested mode with benchmark_idximg.py standing in for
+# OpenKh.Command.IdxImg.exe. Every mode runs in its own process so wall time, peak RSS and bytes written are per mode.
+#
+#   python benchmark.py --assets 2000 --asset-size 262144 --mod-files 500 --modes patch,patch,restore,extract --json bench.json
+#
+# --verify-extract afterwards drops the shared assets from the last pkg's .hed, so an earlier pkg wins them again, and
+# checks that an incremental extract gives the same files as -fullrebuild.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STANDIN = os.path.join(REPO_DIR, "benchmark_idximg.py")
+GAME = "kh2"
+PKGS = ["kh2_first", "kh2_second", "kh2_third", "kh2_fourth", "kh2_fifth", "kh2_sixth"]
+HED_ENTRY = struct.Struct("<16sqii")
+
+def write_standin_wrapper(openkhdir):
+    #IdxImg is started directly by subprocess, so wrap the python stand-in in something executable
+    if os.name == "nt":
+        idxpath = os.path.join(openkhdir, "OpenKh.Command.IdxImg.cmd")
+        with open(idxpath, "w") as f:
+            f.write('@"{}" "{}" %*\n'.format(sys.executable, STANDIN))
+    else:
+        idxpath = os.path.join(openkhdir, "OpenKh.Command.IdxImg.exe")
+        with open(idxpath, "w") as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, STANDIN))
+        os.chmod(idxpath, 0o755)
+    return idxpath
+
+def generate(workdir, opts):
+    rng = random.Random(opts.seed)
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    openkhdir = os.path.join(workdir, "openkh")
+    pkgdir = os.path.join(workdir, "game", "Image", "en")
+    moddir = os.path.join(openkhdir, "mod")
+    patchesdir = os.path.join(workdir, "patches")
+    for d in [openkhdir, pkgdir, moddir, patchesdir, os.path.join(workdir, "extracted")]:
+        os.makedirs(d)
+    pkgs = PKGS[:opts.pkgs]
+
+    #every pkg gets its own assets, and a share of them also live in a second pkg like in the real game
+    names = []
+    pkgmap = {}
+    pkg_assets = {pkg: [] for pkg in pkgs}
+    for i in range(opts.assets):
+        name = "bench{}/asset{:06d}.bin".format(i % 16, i)
+        owners = [pkgs[i % len(pkgs)]]
+        if len(pkgs) > 1 and rng.random() < opts.shared:
+            owners.append(pkgs[(i + 1) % len(pkgs)])
+        names.append(name)
+        pkgmap[name.replace("/", "\\")] = owners
+        for pkg in owners:
+            pkg_assets[pkg].append(name)
+    for pkg in pkgs:
+        offset = 0
+        with open(os.path.join(pkgdir, pkg + ".pkg"), "wb") as pkgf, open(os.path.join(pkgdir, pkg + ".hed"), "wb") as hedf:
+            for name in pkg_assets[pkg]:
+                data = rng.randbytes(opts.asset_size)
+                pkgf.write(data)
+                hedf.write(HED_ENTRY.pack(hashlib.md5(name.encode("utf-8")).digest(), offset, len(data), len(data)))
+                offset += len(data)
+    namesfn = os.path.join(openkhdir, "names.txt")
+    with open(namesfn, "w", encoding="utf-8") as f:
+        f.write("\n".join(names) + "\n")
+    json.dump({GAME: pkgmap}, open(os.path.join(workdir, "pkgmap.json"), "w"))
+    json.dump({}, open(os.path.join(workdir, "pkgmap_extras.json"), "w"))
+    json.dump({}, open(os.path.join(workdir, "pkgmap_blacklist.json"), "w"))
+
+    for name in rng.sample(names, min(opts.mod_files, len(names))):
+        fn = os.path.join(moddir, *name.split("/"))
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, "wb") as f:
+            f.write(rng.randbytes(opts.mod_size))
+    for p in range(opts.patches):
+        with ZipFile(os.path.join(patchesdir, "bench{:02d}.kh2pcpatch".format(p)), "w") as z:
+            for name in rng.sample(names, min(opts.patch_files, len(names))):
+                pkg = pkgmap[name.replace("/", "\\")][0]
+                z.writestr("{}/original/{}".format(pkg, name), rng.randbytes(opts.mod_size))
+
+    return {
+        "workdir": workdir,
+        "openkh_path": openkhdir,
+        "khgame_path": os.path.join(workdir, "game"),
+        "extracted_games_path": os.path.join(workdir, "extracted"),
+        "patches_path": patchesdir,
+        "idxpath": write_standin_wrapper(openkhdir),
+        "names": namesfn,
+    }
+
+def peak_rss():
+    #bytes, for this process and for the largest IdxImg stand-in it started
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset, None
+        except (ImportError, AttributeError):
+            return None, None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+def bytes_written():
+    #bytes handed to write()/sendfile(). on linux the counters of reaped children are folded into the parent, so this
+    #includes what the IdxImg stand-in wrote
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return getattr(counters, "write_chars", counters.write_bytes)
+    except (ImportError, AttributeError):
+        pass
+    if os.path.exists("/proc/self/io"):
+        for line in open("/proc/self/io"):
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    return None
+
+def run_child(resultfn, cli_args):
+    #runs inside the per mode process, with the synthetic workdir as cwd
+    start = time.perf_counter()
+    sys.path.insert(0, REPO_DIR)
+    import build_from_mm
+    import_time = time.perf_counter() - start
+    written_before = bytes_written()
+    error = None
+    start = time.perf_counter()
+    try:
+        build_from_mm.main(cli_args=cli_args)
+    except Exception as err:
+        error = str(err)
+    wall = time.perf_counter() - start
+    written = bytes_written()
+    rss, idximg_rss = peak_rss()
+    result = {
+        "wall_time": wall,
+        "import_time": import_time,
+        "peak_rss": rss,
+        "idximg_peak_rss": idximg_rss,
+        "bytes_written": written - written_before if written is not None and written_before is not None else None,
+        "error": error,
+    }
+    with open(resultfn, "w") as f:
+        json.dump(result, f)
+
+def run_mode(tree, mode, label, extra_args):
+    resultfn = os.path.join(tree["workdir"], "bench_result.json")
+    reportfn = os.path.join(tree["workdir"], "bench_report_{}.json".format(label))
+    logfn = os.path.join(tree["workdir"], "bench_{}.log".format(label))
+    cli_args = [
+        "-game=" + GAME,
+        "-mode=" + mode,
+        "-region=us",
+        "-openkh_path=" + tree["openkh_path"],
+        "-khgame_path=" + tree["khgame_path"],
+        "-extracted_games_path=" + tree["extracted_games_path"],
+        "-patches_path=" + tree["patches_path"],
+        "-idxpath=" + tree["idxpath"],
+        "-report=" + reportfn,
+    ] + extra_args
+    env = dict(os.environ, BRIDGE_BENCH_NAMES=tree["names"])
+    with open(logfn, "w") as log:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", resultfn, "--"] + cli_args,
+                       cwd=tree["workdir"], env=env, stdout=log, stderr=subprocess.STDOUT, check=False)
+    if not os.path.exists(resultfn):
+        return {"mode": label, "error": "benchmark child crashed, see {}".format(logfn)}
+    result = json.load(open(resultfn))
+    os.remove(resultfn)
+    result["mode"] = label
+    result["log"] = logfn
+    if os.path.exists(reportfn):
+        #the bridge's own per phase report
+        result["phases"] = {phase["name"]: phase["wall"] for phase in json.load(open(reportfn))["phases"]}
+    return result
+
+def hash_tree(folder):
+    hashes = {}
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            fn = os.path.join(root, file)
+            with open(fn, "rb") as f:
+                hashes[os.path.relpath(fn, folder)] = hashlib.md5(f.read()).hexdigest()
+    return hashes
+
+def verify_extract(tree, extra_args):
+    #-> list of differences between an incremental extract and -fullrebuild, after the last pkg lost its shared assets
+    pkgdir = os.path.join(tree["khgame_path"], "Image", "en")
+    pkgmap = json.load(open(os.path.join(tree["workdir"], "pkgmap.json")))[GAME]
+    pkgs = sorted(fn[:-4] for fn in os.listdir(pkgdir) if fn.endswith(".hed"))
+    last = pkgs[-1]
+    shared = {hashlib.md5(name.replace("\\", "/").encode("utf-8")).digest() for name, owners in pkgmap.items() if last in owners and len(owners) > 1}
+    results = [run_mode(tree, "extract", "verify_extract_before", extra_args)]
+    hedfn = os.path.join(pkgdir, last + ".hed")
+    with open(hedfn, "rb") as f:
+        entries = [entry for entry in HED_ENTRY.iter_unpack(f.read()) if entry[0] not in shared]
+    with open(hedfn, "wb") as f:
+        for entry in entries:
+            f.write(HED_ENTRY.pack(*entry))
+    extracted = os.path.join(tree["extracted_games_path"], GAME)
+    results.append(run_mode(tree, "extract", "verify_extract_incremental", extra_args))
+    incremental = hash_tree(extracted)
+    results.append(run_mode(tree, "extract", "verify_extract_full", extra_args + ["-fullrebuild"]))
+    full = hash_tree(extracted)
+    differences = sorted(rel for rel in set(incremental) | set(full) if incremental.get(rel) != full.get(rel))
+    for r in results:
+        if r.get("error"):
+            differences.append("{} failed: {}".format(r["mode"], r["error"]))
+    return results, differences
+
+def mb(value):
+    return "-" if value is None else "{:.1f}".format(value / (1024 * 1024))
+
+def print_report(results):
+    print("{:<16} {:>9} {:>9} {:>12} {:>14} {:>12}".format("mode", "wall s", "import s", "peak RSS MB", "IdxImg RSS MB", "written MB"))
+    for r in results:
+        if "wall_time" not in r:
+            print("{:<16} {}".format(r["mode"], r["error"]))
+            continue
+        print("{:<16} {:>9.3f} {:>9.3f} {:>12} {:>14} {:>12}".format(
+            r["mode"], r["wall_time"], r["import_time"], mb(r["peak_rss"]), mb(r["idximg_peak_rss"]), mb(r["bytes_written"])))
+        if r["error"]:
+            print("    failed: {}".format(r["error"]))
+        if r.get("phases"):
+            print("    " + ", ".join("{} {:.3f}s".format(name, wall) for name, wall in r["phases"].items()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark build_from_mm.py against a synthetic game tree")
+    parser.add_argument("--workdir", default="bench_work", help="where the synthetic tree is generated (wiped first)")
+    parser.add_argument("--pkgs", type=int, default=6, choices=range(1, len(PKGS) + 1), help="number of kh2 pkgs")
+    parser.add_argument("--assets", type=int, default=600, help="total number of assets across all pkgs")
+    parser.add_argument("--asset-size", type=int, default=64 * 1024, help="bytes per asset")
+    parser.add_argument("--shared", type=float, default=0.2, help="fraction of assets that also live in a second pkg")
+    parser.add_argument("--mod-files", type=int, default=100, help="files in the Mods Manager mod folder")
+    parser.add_argument("--mod-size", type=int, default=64 * 1024, help="bytes per mod file and patch member")
+    parser.add_argument("--patches", type=int, default=2, help="number of .kh2pcpatch archives")
+    parser.add_argument("--patch-files", type=int, default=50, help="members per .kh2pcpatch archive")
+    parser.add_argument("--modes", default="patch,patch,restore,extract", help="comma separated modes, run in order against the same tree")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verify-extract", action="store_true", help="after the modes, check that an incremental extract matches -fullrebuild")
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    parser.add_argument("--child", default="", help=argparse.SUPPRESS)
+    parser.add_argument("bridge_args", nargs="*", help="extra arguments for build_from_mm, after --")
+    opts = parser.parse_args(argv)
+
+    if opts.child:
+        run_child(opts.child, opts.bridge_args)
+        return
+
+    workdir = os.path.abspath(opts.workdir)
+    start = time.perf_counter()
+    tree = generate(workdir, opts)
+    print("Generated synthetic tree in {} ({:.2f}s)".format(workdir, time.perf_counter() - start))
+    results = []
+    seen = {}
+    for mode in [m.strip() for m in opts.modes.split(",") if m.strip()]:
+        seen[mode] = seen.get(mode, 0) + 1
+        label = mode if seen[mode] == 1 else "{}#{}".format(mode, seen[mode])
+        results.append(run_mode(tree, mode, label, opts.bridge_args))
+    differences = None
+    if opts.verify_extract:
+        verify_results, differences = verify_extract(tree, opts.bridge_args)
+        results += verify_results
+    print_report(results)
+    if differences is not None:
+        if differences:
+            print("Incremental extract differs from -fullrebuild in {} files:".format(len(differences)))
+            for rel in differences[:20]:
+                print("    " + rel)
+        else:
+            print("Incremental extract matches -fullrebuild")
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump({"options": {k: v for k, v in vars(opts).items() if k != "child"}, "results": results, "extract_differences": differences}, f, indent=2)
+    if differences:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
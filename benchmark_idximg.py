@@ -0,0 +1,95 @@
+import sys, os, struct, hashlib
+
+# Stand-in for OpenKh.Command.IdxImg.exe used by benchmark.py, so the bridge can be timed without the real game or OpenKH.
+# It understands the two commands the bridge uses:
+#   hed extract <file.hed> -o <outdir>
+#   hed patch <file.pkg> <modfolder> -o <outdir>
+# The .hed files use the real layout (0x20 byte entries: md5 of the asset name, offset, data length, actual length),
+# but the .pkg files are plain concatenated asset data without the EGS asset headers, compression or encryption.
+# Patching moves replaced assets to the end of the .pkg, so even a same size replacement changes the .hed.
+# Asset names are resolved from the file named by BRIDGE_BENCH_NAMES (one name per line), like IdxImg's own name list.
+
+HED_ENTRY = struct.Struct("<16sqii")
+
+def load_names():
+    names = {}
+    namesfn = os.environ.get("BRIDGE_BENCH_NAMES", "")
+    if namesfn and os.path.exists(namesfn):
+        for line in open(namesfn, encoding="utf-8"):
+            name = line.strip()
+            if name:
+                names[hashlib.md5(name.encode("utf-8")).digest()] = name
+    return names
+
+def read_hed(hedfn):
+    data = open(hedfn, "rb").read()
+    return [HED_ENTRY.unpack_from(data, offset) for offset in range(0, len(data) - len(data) % HED_ENTRY.size, HED_ENTRY.size)]
+
+def extract(hedfn, outdir):
+    names = load_names()
+    with open(hedfn[:-4] + ".pkg", "rb") as pkg:
+        for md5, offset, datalength, actuallength in read_hed(hedfn):
+            name = names.get(md5, md5.hex())
+            pkg.seek(offset)
+            data = pkg.read(actuallength)
+            fn = os.path.join(outdir, "original", *name.split("/"))
+            if not os.path.exists(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, "wb") as f:
+                f.write(data)
+            print("Extracted {}".format(name), flush=True)
+
+def patch(pkgfn, modfolder, outdir):
+    names = load_names()
+    modfiles = {}
+    originaldir = os.path.join(modfolder, "original")
+    for root, dirs, files in os.walk(originaldir):
+        for file in files:
+            fn = os.path.join(root, file)
+            modfiles[os.path.relpath(fn, originaldir).replace(os.sep, "/")] = fn
+    os.makedirs(outdir, exist_ok=True)
+    basename = os.path.basename(pkgfn)[:-4]
+    entries = []
+    offset = 0
+    replaced = []
+    with open(pkgfn, "rb") as pkg, open(os.path.join(outdir, basename + ".pkg"), "wb") as out:
+        #untouched assets are copied in order, replaced ones move to the end of the pkg like a real patch, so the
+        #patched .hed always differs from the original
+        for md5, oldoffset, datalength, actuallength in read_hed(pkgfn[:-4] + ".hed"):
+            name = names.get(md5)
+            if name in modfiles:
+                replaced.append((md5, name, modfiles.pop(name)))
+                continue
+            pkg.seek(oldoffset)
+            data = pkg.read(actuallength)
+            out.write(data)
+            entries.append((md5, offset, len(data), len(data)))
+            offset += len(data)
+        for md5, name, fn in replaced:
+            data = open(fn, "rb").read()
+            out.write(data)
+            entries.append((md5, offset, len(data), len(data)))
+            offset += len(data)
+            print("Replacing {}".format(name), flush=True)
+        for name, fn in sorted(modfiles.items()):
+            data = open(fn, "rb").read()
+            out.write(data)
+            entries.append((hashlib.md5(name.encode("utf-8")).digest(), offset, len(data), len(data)))
+            offset += len(data)
+            print("Adding {}".format(name), flush=True)
+    with open(os.path.join(outdir, basename + ".hed"), "wb") as hed:
+        for entry in entries:
+            hed.write(HED_ENTRY.pack(*entry))
+
+def main(argv):
+    if len(argv) >= 5 and argv[0] == "hed" and argv[1] == "extract" and argv[3] == "-o":
+        extract(argv[2], argv[4])
+    elif len(argv) >= 6 and argv[0] == "hed" and argv[1] == "patch" and argv[4] == "-o":
+        patch(argv[2], argv[3], argv[5])
+    else:
+        print("Unsupported command: {}".format(" ".join(argv)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
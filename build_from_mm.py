@@ -1,19 +1,28 @@
-import sys, os, shutil, subprocess, json, time, argparse
-from gooey import Gooey, GooeyParser
+import sys, os, shutil, subprocess, json, time, argparse, atexit, threading, mmap, struct, fnmatch, tempfile, errno, signal, collections
 from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # CLI usage example
 #In [1]: import build_from_mm
 #In [2]: build_from_mm.main(cli_args=["-game=kh2", "-mode=patch"])
 
+# Library usage example (plan first without touching the game files, execute later)
+#In [1]: import build_from_mm
+#In [2]: args = build_from_mm.parse_args(["-game=kh2", "-mode=patch"])
+#In [3]: plan = build_from_mm.build_plan(args)
+#In [4]: plan.save("kh2_plan.json")
+#In [5]: build_from_mm.execute_plan(build_from_mm.PatchPlan.load("kh2_plan.json"), args)
+
 # TODO 1.0.8 has new checksums for some of the packages, warn if on wrong checksomes
 
 # TODO bundle as one file
 # TODO support HD paths (DA: should be fine now)
 # TODO bundle the pkgmap.json and pkgmap_extras.json as resources in the executable
-# TODO add music only extract
 # TODO blacklist bad directory paths, hide most output and make obvious errors more obvious (try to bulletproof it for non technical people)
-# TODO make it a library
 # TODO make a pypi package
 
 VERBOSE_PRINTS = False
@@ -21,14 +30,166 @@ VERBOSE_PRINTS = False
 def print_debug(*args, **kwargs):
     verbose = "verbose" in kwargs and kwargs["verbose"]
     if (not verbose) or (verbose and VERBOSE_PRINTS):
-        print(''.join([str(s) for s in args]))
-    
+        #single write so lines from worker threads don't interleave
+        sys.stdout.write(''.join([str(s) for s in args]) + "\n")
+
+def io_snapshot():
+    #process wide io counters, on linux these include the IdxImg processes we already waited for
+    try:
+        import psutil
+        c = psutil.Process().io_counters()
+        return {"read_bytes": getattr(c, "read_chars", c.read_bytes), "write_bytes": getattr(c, "write_chars", c.write_bytes),
+                "read_syscalls": c.read_count, "write_syscalls": c.write_count}
+    except (ImportError, AttributeError):
+        pass
+    if os.path.exists("/proc/self/io"):
+        values = dict(line.split(": ") for line in open("/proc/self/io").read().splitlines())
+        return {"read_bytes": int(values["rchar"]), "write_bytes": int(values["wchar"]),
+                "read_syscalls": int(values["syscr"]), "write_syscalls": int(values["syscw"])}
+    return None
+
+audit_hook_installed = False
+
+class Instrumentation:
+    #times the phases of a run and counts files, bytes and syscalls for each of them. phases run one after another
+    #on the thread that started them (the main thread, or one thread per game in a batch, whose phases get the game
+    #name as prefix), timers (checksums, IdxImg calls, copy back) can run on any thread and add up.
+    #file system calls are counted through an audit hook, which is only installed when a report was asked for
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.starttime = time.time()
+        self.phases = []
+        self.current = None
+        self.timers = {}
+        if enabled:
+            global audit_hook_installed
+            if not audit_hook_installed:
+                #audit hooks can't be removed, so there is only ever one and it reports to whatever instance is active
+                sys.addaudithook(lambda event, args: instrumentation.audit(event))
+                audit_hook_installed = True
+    def audit(self, event):
+        #worker threads don't have a phase of their own and count towards the most recently started one
+        phase = getattr(self.local, "phase", None) or self.current
+        if not self.enabled or phase is None:
+            return
+        if event == "open" or event.startswith("os.") or event.startswith("shutil.") or event.startswith("subprocess.") or event == "mmap.__new__":
+            events = phase["syscalls"]
+            with self.lock:
+                events[event] = events.get(event, 0) + 1
+    def start(self, name):
+        #ends the running phase of this thread and starts the next one
+        self.end()
+        phase = {"name": getattr(self.local, "prefix", "") + name, "start": time.time(), "syscalls": {}, "io": io_snapshot()}
+        self.local.phase = phase
+        self.current = phase
+    def end(self):
+        phase = getattr(self.local, "phase", None)
+        if phase is None:
+            return
+        self.local.phase = None
+        if self.current is phase:
+            self.current = None
+        phase["wall"] = time.time() - phase.pop("start")
+        before, after = phase["io"], io_snapshot()
+        phase["io"] = {key: after[key] - before[key] for key in after} if before and after else None
+        phase["files"] = phase["syscalls"].get("open", 0)
+        with self.lock:
+            self.phases.append(phase)
+    def add(self, name, seconds, files=1, nbytes=0):
+        with self.lock:
+            timer = self.timers.setdefault(name, {"count": 0, "seconds": 0.0, "bytes": 0})
+            timer["count"] += files
+            timer["seconds"] += seconds
+            timer["bytes"] += nbytes
+    def report(self, **extra):
+        self.end()
+        report = dict(extra)
+        report["total_wall"] = time.time() - self.starttime
+        report["phases"] = self.phases
+        report["timers"] = self.timers
+        return report
+    def summary(self):
+        return " | ".join("{} {}s".format(phase["name"], round(phase["wall"], 2)) for phase in self.phases)
+
+instrumentation = Instrumentation()
+
+class ModTreeSnapshot:
+    #one walk over the mods manager output. translate_path checks this instead of stat'ing the mod folder for every file.
+    #files maps every mod file to its path relative to the mod folder (with a leading separator)
+    def __init__(self, moddir):
+        self.moddir = moddir
+        self.files = {}
+        self.paths = set()
+        if os.path.exists(moddir):
+            for root, dirs, files in os.walk(moddir):
+                for file in files:
+                    self.add(os.path.join(root, file))
+    def add(self, fn):
+        relfn = fn.replace(self.moddir, '')
+        self.files[fn] = relfn
+        self.paths.add(os.path.normcase(relfn.lstrip(os.sep)))
+    def remove(self, fn):
+        relfn = self.files.pop(fn)
+        self.paths.discard(os.path.normcase(relfn.lstrip(os.sep)))
+    def exists(self, relpath):
+        #normcase so this matches os.path.isfile on case insensitive windows drives
+        return os.path.normcase(relpath.lstrip(os.sep)) in self.paths
+    def update(self, changed):
+        #applies a batch of changed paths without walking the rest of the tree. files are dict lookups, only folders
+        #that were removed or created/moved in need one pass over the snapshot for all of them together
+        folders = []
+        for path in changed:
+            if os.path.isfile(path):
+                self.add(path)
+            elif path in self.files:
+                self.remove(path)
+            else:
+                folders.append(path)
+        if not folders:
+            return
+        prefixes = tuple(folder.rstrip(os.sep) + os.sep for folder in folders)
+        for fn in [fn for fn in self.files if fn.startswith(prefixes)]:
+            self.remove(fn)
+        for folder in folders:
+            if os.path.isdir(folder):
+                for root, dirs, files in os.walk(folder):
+                    for file in files:
+                        self.add(os.path.join(root, file))
+
+kh2_rules_cache = {}
+
+def kh2_translation_rules(region):
+    #PS2 paths -> PC paths as (applies, translate) pairs, applied in order to the result of the previous rule.
+    #built once per region so translating a path is only a few string operations
+    if region in kh2_rules_cache:
+        return kh2_rules_cache[region]
+    jp = os.sep+"jp"+os.sep
+    jp_region = os.sep+region+os.sep
+    ard = "ard"+os.sep
+    ard_region = "ard"+os.sep+region+os.sep
+    fm_region = ".a.{}".format(region)
+    rules = [
+        (lambda path: jp in path and not ".2ld" in path,
+            lambda path: path.replace(jp, jp_region)),
+        (lambda path: "ard" in path and path.count(os.sep) == 1,
+            lambda path: path.replace(ard, ard_region)),
+        #maps don't have region specifier for some reason, or they split it out into two files for some reason...
+        (lambda path: "map" in path and path.count(os.sep) == 2,
+            lambda path: path.split("map")[0]+"map"+os.sep+path.split(os.sep)[-1]),
+        (lambda path: path.endswith(".a.fm"),
+            lambda path: path.replace(".a.fm", fm_region)),
+    ]
+    kh2_rules_cache[region] = rules
+    return rules
+
 class KingdomHearts1Patcher:
     def __init__(self, region):
         self.region = region
         self.name = "kh1"
         self.pkgs = ["kh1_first.pkg", "kh1_second.pkg", "kh1_third.pkg", "kh1_fourth.pkg", "kh1_fifth.pkg"]
-    def translate_path(self, path, moddir):
+    def translate_path(self, path, snapshot):
         if path.startswith(os.sep):
             path = path[1:]
         return path
@@ -40,39 +201,17 @@ class KingdomHearts2Patcher:
         self.region = region
         self.name = "kh2"
         self.pkgs = ["kh2_first.pkg", "kh2_second.pkg", "kh2_third.pkg", "kh2_fourth.pkg", "kh2_fifth.pkg", "kh2_sixth.pkg"]
-    def translate_path(self, path, moddir):
+    def translate_path(self, path, snapshot):
         if path.startswith(os.sep):
             path = path[1:]
-        #only translate paths that aren't in the raw or remastred folders
+        #only translate paths that aren't in the raw or remastered folders
         #this is because those paths are always only used for the PC port
-        if not path.startswith("remastered"+os.sep) or not path.startswith("raw"+os.sep):
-            if os.sep+"jp"+os.sep in path:
-                if not ".2ld" in path:
-                    #check to see if the translated path already exists and ignore if it does
-                    prepath = path.replace(os.sep+"jp"+os.sep, os.sep+self.region+os.sep)
-                    PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                    if not PCverExists:
-                        path = prepath
-            if "ard" in path:
-                if path.count(os.sep) == 1:
-                    #check to see if the translated path already exists and ignore if it does
-                    prepath = path.replace("ard"+os.sep, "ard"+os.sep+self.region+os.sep)
-                    PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                    if not PCverExists:
-                        path = prepath
-            if "map" in path:
-                if path.count(os.sep) == 2:
-                #maps don't have region specifier for some reason, or they split it out into two files for some reason...
-                    #check to see if the translated path already exists and ignore if it does
-                    prepath = path.split("map")[0]+"map"+os.sep+path.split(os.sep)[-1]
-                    PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                    if not PCverExists:
-                        path = prepath
-            if path.endswith(".a.fm"):
+        #(the old guard here used `or` and so never excluded anything, the rules keep that behaviour)
+        for applies, translate in kh2_translation_rules(self.region):
+            if applies(path):
                 #check to see if the translated path already exists and ignore if it does
-                prepath = path.replace(".a.fm", ".a.{}".format(self.region))
-                PCverExists = os.path.isfile(moddir+os.sep+prepath)
-                if not PCverExists:
+                prepath = translate(path)
+                if not snapshot.exists(prepath):
                     path = prepath
         return path
     def translate_pkg_path(self, path):
@@ -83,7 +222,7 @@ class BirthBySleepPatcher:
         self.region = region
         self.name = "bbs"
         self.pkgs = ["bbs_first.pkg", "bbs_second.pkg", "bbs_third.pkg", "bbs_fourth.pkg"]
-    def translate_path(self, path, moddir):
+    def translate_path(self, path, snapshot):
         if path.startswith(os.sep):
             path = path[1:]
         return path
@@ -94,7 +233,7 @@ class KingdomHearts3DPatcher:
         self.region = region
         self.name = "kh3d"
         self.pkgs = ["kh3d_first.pkg", "kh3d_second.pkg", "kh3d_third.pkg", "kh3d_fourth.pkg"]
-    def translate_path(self, path, moddir):
+    def translate_path(self, path, snapshot):
         if path.startswith(os.sep):
             path = path[1:]
         return path
@@ -106,7 +245,7 @@ class RecomPatcher:
         self.region = region
         self.name = "recom"
         self.pkgs = ["Recom.pkg"]
-    def translate_path(self, path, moddir):
+    def translate_path(self, path, snapshot):
         if path.startswith(os.sep):
             path = path[1:]
         return path
@@ -117,7 +256,7 @@ class MoviesPatcher:
         self.region = region
         self.name = "mare"
         self.pkgs = ["Mare.pkg"]
-    def translate_path(self, path, moddir):
+    def translate_path(self, path, snapshot):
         if path.startswith(os.sep):
             path = path[1:]
         return path
@@ -194,23 +333,657 @@ checksums = {
 
 import hashlib 
 
-def validChecksum(path):
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+CHECKSUM_CACHE_PATH = "checksum_cache.json"
+BUILD_MANIFEST_PATH = "build_manifest.json"
+EXTRACT_MANIFEST_PATH = "extract_manifest.json"
+STATE_JOURNAL_PATH = "bridge_state.json"
+
+def load_state(path):
+    if os.path.exists(path):
+        try:
+            return json.load(open(path))
+        except ValueError:
+            print_debug("WARNING: {} is corrupt, ignoring it".format(path))
+    return {}
+
+def save_state(path, data):
+    #write to a temp file and rename it over the old one so an interrupted run never leaves a half written file
+    tmpfn = path + ".tmp"
+    with open(tmpfn, "w") as f:
+        json.dump(data, f)
+    os.replace(tmpfn, path)
+
+def md5_file(path):
+    #hash in fixed size chunks with a reused buffer so memory stays flat even for multi-GB pkgs
+    md5 = hashlib.md5()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+class ChecksumCache:
+    #persistent md5 cache keyed on (path, size, mtime_ns, inode) so unchanged files are never rehashed
+    def __init__(self, path=CHECKSUM_CACHE_PATH):
+        self.path = path
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.entries = load_state(path)
+    def md5(self, path):
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        sig = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self.entries.get(key)
+        if entry is not None and entry[:3] == sig:
+            return entry[3]
+        hashstart = time.time()
+        checksum = md5_file(path)
+        instrumentation.add("checksum", time.time() - hashstart, nbytes=st.st_size)
+        self.remember(path, checksum)
+        return checksum
+    def remember(self, path, checksum):
+        #for files we just wrote ourselves and already know the md5 of
+        st = os.stat(path)
+        with self.lock:
+            self.entries[os.path.abspath(path)] = [st.st_size, st.st_mtime_ns, st.st_ino, checksum]
+            self.dirty = True
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            save_state(self.path, self.entries)
+            self.dirty = False
+
+checksum_cache = None
+
+def get_checksum_cache():
+    global checksum_cache
+    if checksum_cache is None:
+        checksum_cache = ChecksumCache()
+        atexit.register(checksum_cache.save)
+    return checksum_cache
+
+def validChecksum(path, checksum=None):
+    #checksum is for callers that already hashed path while reading it
     pkgname = path.split(os.sep)[-1]
     if pkgname not in checksums:
         raise Exception("Error: Checksum for {} not found!".format(pkgname))
-    checksum = hashlib.md5(open(path,'rb').read()).hexdigest()
+    if checksum is None:
+        checksum = get_checksum_cache().md5(path)
     if not checksum == checksums[pkgname]:
         print_debug("PKG {} has changed checksum!".format(pkgname))
         return False
     return True
 
-@Gooey(program_name="Mod Manager Bridge")
-def main_ui():
-    main()
+PKGMAP_SOURCES = ["pkgmap.json", "pkgmap_extras.json", "pkgmap_blacklist.json"]
+PKGMAP_INDEX_DIR = "pkgmap_index"
+PKGMAP_INDEX_VERSION = 1
 
-def main(cli_args: list = []):
-    starttime = time.time()
+def normalize_pkgmap_path(path):
+    #pkgmap keys are written with windows separators, everything in the index uses "/" so lookups work on any OS
+    return path.replace("\\", "/").replace(os.sep, "/").lstrip("/")
+
+def pkgmap_sources_signature():
+    sig = []
+    for fn in PKGMAP_SOURCES:
+        st = os.stat(fn)
+        sig.append([fn, st.st_size, st.st_mtime_ns])
+    return sig
+
+def compile_pkgmap_index(indexdir=PKGMAP_INDEX_DIR):
+    #merges pkgmap.json, the extras and the blacklist once for every game and writes one sorted index file per game.
+    #each line is "path<TAB>pkgs<TAB>blacklisted pkgs", the first line holds the signature of the source files
+    print_debug("Compiling pkgmap index")
+    header = "#pkgmap-index {} {}\n".format(PKGMAP_INDEX_VERSION, json.dumps(pkgmap_sources_signature()))
+    pkgmap, pkgmap_extras, pkgmap_blacklist = [json.load(open(fn)) for fn in PKGMAP_SOURCES]
+    if not os.path.exists(indexdir):
+        os.makedirs(indexdir)
+    gamenames = set(pkgmap) | set(pkgmap_extras) | set(pkgmap_blacklist)
+    #games without any entries still get an (empty) index so they aren't recompiled on every run
+    gamenames.update(games[g]("").name for g in games)
+    for gamename in gamenames:
+        entries = {}
+        for path, pkgs in pkgmap.get(gamename, {}).items():
+            entries[normalize_pkgmap_path(path)] = [pkgs, []]
+        # predefined extras for patches that fail otherwise, such as GOA ROM
+        for path, pkgs in pkgmap_extras.get(gamename, {}).items():
+            entries[normalize_pkgmap_path(path)] = [pkgs, []]
+        # blacklist of bad files to replace
+        for path, pkgs in pkgmap_blacklist.get(gamename, {}).items():
+            entries.setdefault(normalize_pkgmap_path(path), [[], []])[1] = pkgs
+        lines = ["{}\t{}\t{}\n".format(path, ",".join(pkgs), ",".join(blk)) for path, (pkgs, blk) in entries.items()]
+        lines.sort(key=lambda line: line.encode("utf-8"))
+        indexfn = os.path.join(indexdir, gamename + ".idx")
+        tmpfn = "{}.{}.tmp".format(indexfn, os.getpid())
+        with open(tmpfn, "w", encoding="utf-8", newline="\n") as f:
+            f.write(header)
+            f.writelines(lines)
+        os.replace(tmpfn, indexfn)
+
+class PkgMapIndex:
+    #memory mapped, binary searched view of one game of the compiled pkgmap, so opening it costs the same no matter
+    #how big the full multi game pkgmap is
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = self.mm.find(b"\n") + 1
+    @classmethod
+    def open(cls, gamename, indexdir=PKGMAP_INDEX_DIR):
+        indexfn = os.path.join(indexdir, gamename + ".idx")
+        header = "#pkgmap-index {} {}".format(PKGMAP_INDEX_VERSION, json.dumps(pkgmap_sources_signature()))
+        current = None
+        if os.path.exists(indexfn):
+            with open(indexfn, encoding="utf-8") as f:
+                current = f.readline().rstrip("\n")
+        if current != header:
+            compile_pkgmap_index(indexdir)
+        return cls(indexfn)
+    def close(self):
+        self.mm.close()
+        self.file.close()
+    def _line(self, pos):
+        end = self.mm.find(b"\n", pos)
+        if end == -1:
+            end = len(self.mm)
+        return self.mm[pos:end].decode("utf-8").split("\t"), end + 1
+    def _bisect(self, key):
+        #offset of the first line whose path is >= key
+        lo, hi = self.start, len(self.mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            linestart = self.mm.rfind(b"\n", lo, mid) + 1 or lo
+            (path, _, _), nextline = self._line(linestart)
+            if path.encode("utf-8") < key:
+                lo = nextline
+            else:
+                hi = linestart
+        return lo
+    def _lookup(self, path):
+        path = normalize_pkgmap_path(path)
+        pos = self._bisect(path.encode("utf-8"))
+        if pos >= len(self.mm):
+            return None
+        fields, _ = self._line(pos)
+        if fields[0] != path:
+            return None
+        return fields
+    def get(self, path, default=""):
+        fields = self._lookup(path)
+        if fields is None or not fields[1]:
+            return default
+        return fields[1].split(",")
+    def blacklisted(self, path, default=""):
+        fields = self._lookup(path)
+        if fields is None or not fields[2]:
+            return default
+        return fields[2].split(",")
+    def prefix(self, prefix):
+        #yields (path, pkgs, blacklisted pkgs) for every entry below a directory like "bgm/"
+        prefix = normalize_pkgmap_path(prefix)
+        pos = self._bisect(prefix.encode("utf-8"))
+        while pos < len(self.mm):
+            (path, pkgs, blk), pos = self._line(pos)
+            if not path.startswith(prefix):
+                break
+            yield path, pkgs.split(",") if pkgs else [], blk.split(",") if blk else []
+
+HED_ENTRY = struct.Struct("<16sqii")
+
+class HedIndex:
+    #memory mapped .hed of one pkg. every 0x20 byte entry is the md5 of the asset name, the offset of the asset in the
+    #.pkg, its stored length and its real length. the names themselves only exist in the pkgmap
+    def __init__(self, hedfn):
+        self.hedfn = hedfn
+        self.file = open(hedfn, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.count = size // HED_ENTRY.size
+        self.positions = None
+    def close(self):
+        if self.mm:
+            self.mm.close()
+        self.file.close()
+    def entry(self, i):
+        #(md5, offset, data length, actual length)
+        return HED_ENTRY.unpack_from(self.mm, i * HED_ENTRY.size)
+    def find(self, name):
+        if self.positions is None:
+            self.positions = {self.mm[i*HED_ENTRY.size:i*HED_ENTRY.size+16]: i for i in range(self.count)}
+        i = self.positions.get(hed_hash(name))
+        return None if i is None else self.entry(i)
+
+def hed_hash(name):
+    return hashlib.md5(normalize_pkgmap_path(name).encode("utf-8")).digest()
+
+def asset_matcher(patterns):
+    #patterns are comma separated prefixes like `bgm\` or globs like `bgm/music1*.scd`
+    #-> [(literal prefix to look up in the pkgmap index, glob or None)]
+    matchers = []
+    for pattern in patterns.split(","):
+        pattern = normalize_pkgmap_path(pattern.strip())
+        literal = pattern
+        for i, c in enumerate(pattern):
+            if c in "*?[":
+                literal = pattern[:i]
+                break
+        matchers.append((literal, pattern if literal != pattern else None))
+    return matchers
+
+def list_assets(pkgmap, hedfile, patterns=""):
+    #names of the assets in one pkg that match the patterns, with their hed entries, resolved through the pkgmap
+    #index. remastered files live inside the entry of their original asset so they never have an entry of their own
+    pkgname = os.path.basename(hedfile)[:-4]
+    hed = HedIndex(hedfile)
+    found = {}
+    try:
+        for literal, glob in asset_matcher(patterns):
+            for path, pkgs, blk in pkgmap.prefix(literal):
+                if pkgname not in pkgs or path.startswith("remastered/") or path in found:
+                    continue
+                if glob is not None and not fnmatch.fnmatchcase(path, glob):
+                    continue
+                entry = hed.find(path)
+                if entry is not None:
+                    found[path] = entry
+    finally:
+        hed.close()
+    return sorted(found.items())
+
+BACKUP_STORE_DIR = "backup_store"
+BACKUP_BLOCK_SIZE = 1024 * 1024
+
+class BackupStore:
+    #content addressed store of the original pkg/hed files. objects/<md5[:2]>/<md5> holds the data once no matter how
+    #many games or file names share it, <md5>.blocks the md5 of every BACKUP_BLOCK_SIZE block of it, and index.json
+    #maps file names like "kh2_first.pkg" to their object
+    def __init__(self, path=BACKUP_STORE_DIR):
+        self.path = path
+        self.indexfn = os.path.join(path, "index.json")
+        self.index = load_state(self.indexfn)
+        self.lock = threading.Lock()
+    def object_path(self, checksum):
+        return os.path.join(self.path, "objects", checksum[:2], checksum)
+    def md5(self, name):
+        entry = self.index.get(name)
+        if entry is None or not os.path.exists(self.object_path(entry["md5"])):
+            return None
+        return entry["md5"]
+    def blocks(self, checksum):
+        return json.load(open(self.object_path(checksum) + ".blocks"))
+    def add(self, name, sourcefn, move=False):
+        #one read of the source gives the full md5, the block md5s and the copy
+        objdir = os.path.join(self.path, "objects")
+        if not os.path.exists(objdir):
+            os.makedirs(objdir)
+        tmpfn = os.path.join(objdir, "{}.{}.tmp".format(name, os.getpid()))
+        if move:
+            os.replace(sourcefn, tmpfn)
+        md5 = hashlib.md5()
+        blocks = []
+        with open(tmpfn if move else sourcefn, "rb") as src, open(os.devnull if move else tmpfn, "wb") as dst:
+            for block in iter(lambda: src.read(BACKUP_BLOCK_SIZE), b""):
+                md5.update(block)
+                blocks.append(hashlib.md5(block).hexdigest())
+                if not move:
+                    dst.write(block)
+        checksum = md5.hexdigest()
+        objfn = self.object_path(checksum)
+        if os.path.exists(objfn):
+            #same content is already stored under another name or game
+            os.remove(tmpfn)
+        else:
+            if not os.path.exists(os.path.dirname(objfn)):
+                os.makedirs(os.path.dirname(objfn))
+            save_state(objfn + ".blocks", blocks)
+            os.replace(tmpfn, objfn)
+        with self.lock:
+            self.index[name] = {"md5": checksum, "size": os.path.getsize(objfn)}
+            save_state(self.indexfn, self.index)
+        return checksum
+    def remove(self, name):
+        #drops name from the index, and its object unless another name still shares it
+        with self.lock:
+            entry = self.index.pop(name, None)
+            if entry is None:
+                return
+            save_state(self.indexfn, self.index)
+            if any(other["md5"] == entry["md5"] for other in self.index.values()):
+                return
+        for fn in [self.object_path(entry["md5"]), self.object_path(entry["md5"]) + ".blocks"]:
+            if os.path.exists(fn):
+                os.remove(fn)
+    def import_legacy(self, folder):
+        #backups made before the store existed are moved in rather than copied
+        for name in sorted(os.listdir(folder)):
+            fn = os.path.join(folder, name)
+            if self.md5(name) is None:
+                print_debug("Moving old backup into the backup store: " + fn)
+                self.add(name, fn, move=True)
+        if not os.listdir(folder):
+            os.rmdir(folder)
+    def restore(self, name, dst):
+        #rewrites only the blocks of dst that differ from the original, returns how many bytes were written
+        checksum = self.md5(name)
+        if checksum is None:
+            raise Exception("Error: no backup of {} found, please restore the original file and run patch again".format(name))
+        written = 0
+        size = self.index[name]["size"]
+        with open(self.object_path(checksum), "rb") as src, open(dst, "r+b" if os.path.exists(dst) else "w+b") as f:
+            for i, blockmd5 in enumerate(self.blocks(checksum)):
+                offset = i * BACKUP_BLOCK_SIZE
+                f.seek(offset)
+                if hashlib.md5(f.read(BACKUP_BLOCK_SIZE)).hexdigest() == blockmd5:
+                    continue
+                src.seek(offset)
+                block = src.read(BACKUP_BLOCK_SIZE)
+                f.seek(offset)
+                f.write(block)
+                written += len(block)
+            f.truncate(size)
+        get_checksum_cache().remember(dst, checksum)
+        return written
 
+def pkg_signature(pkgdir, pkg):
+    #size and mtime of an installed pkg/hed pair, used to notice when something other than us changed the game files
+    sig = []
+    for fn in [os.path.join(pkgdir, pkg+".pkg"), os.path.join(pkgdir, pkg+".hed")]:
+        if not os.path.exists(fn):
+            return None
+        st = os.stat(fn)
+        sig += [st.st_size, st.st_mtime_ns]
+    return sig
+
+FICLONE = 0x40049409
+
+class Stager:
+    #puts mod files into khbuild without copying their data when possible. IdxImg only ever reads khbuild, so a
+    #reflink (copy on write clone) or a hardlink is as good as a copy. each method is given up on after its first failure
+    def __init__(self, mode="link"):
+        self.reflink = mode == "link" and fcntl is not None
+        self.hardlink = mode == "link"
+        self.stats = {"reflink": 0, "hardlink": 0, "copy": 0}
+        self.bytes_avoided = 0
+        self.bytes_copied = 0
+    def stage(self, src, dst):
+        size = os.path.getsize(src)
+        if self.reflink:
+            try:
+                with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return self.count("reflink", size)
+            except OSError:
+                self.reflink = False
+                if os.path.exists(dst):
+                    os.remove(dst)
+        if self.hardlink:
+            try:
+                os.link(src, dst)
+                return self.count("hardlink", size)
+            except OSError:
+                #usually the mod folder and khbuild are on different drives
+                self.hardlink = False
+        shutil.copy(src, dst)
+        return self.count("copy", size)
+    def count(self, method, size):
+        self.stats[method] += 1
+        if method == "copy":
+            self.bytes_copied += size
+        else:
+            self.bytes_avoided += size
+        return method
+    def report(self):
+        return "Staged {} files ({} reflinked, {} hardlinked, {} copied), avoided copying {} MB, copied {} MB".format(
+            sum(self.stats.values()), self.stats["reflink"], self.stats["hardlink"], self.stats["copy"],
+            round(self.bytes_avoided / (1024*1024), 2), round(self.bytes_copied / (1024*1024), 2))
+
+class IOSlots:
+    #limits how many disk heavy jobs (backups, restores, IdxImg runs and installing the results) run at the same time,
+    #across every game of a batch. 0 means no limit
+    def __init__(self, limit=0):
+        self.semaphore = threading.BoundedSemaphore(limit) if limit and limit > 0 else None
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return self
+    def __exit__(self, *exc):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+io_slots = IOSlots()
+#default -iolimit of a batch, where every game would otherwise back up, restore and patch at the same time
+BATCH_IOLIMIT = 2
+
+def resolve_workers(workers, jobs):
+    #0 means one worker per core, never start more workers than there are jobs
+    if not workers or workers < 1:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, jobs))
+
+IDXIMG_PROGRESS_INTERVAL = 10
+IDXIMG_TAIL_LINES = 50
+idximg_cancelled = threading.Event()
+
+def format_progress(label, done, total, elapsed):
+    if total and done:
+        eta = elapsed * (total - done) / done
+        return "{}: {}/{} files ({}%), {}s elapsed, ETA {}s".format(label, done, total, min(100, done * 100 // total), round(elapsed), round(max(0, eta)))
+    return "{}: {} files, {}s elapsed, still running".format(label, done, round(elapsed))
+
+def run_idximg(idx_args, action, label, total=0, timeout=0):
+    #shared by extract and patch. IdxImg prints a line for every file it handles, those are streamed into the verbose
+    #log as they come instead of being buffered until it exits, and double as progress for the ETA. the process is
+    #killed when it runs longer than timeout seconds (0 = no limit) or the run gets cancelled
+    if idximg_cancelled.is_set():
+        raise Exception("{} cancelled for {}".format(action, label))
+    idxstart = time.time()
+    #own process group, so a timeout or cancel can kill IdxImg together with anything it (or a wrapper) started
+    if os.name == "nt":
+        proc = subprocess.Popen(idx_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        proc = subprocess.Popen(idx_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    tail = collections.deque(maxlen=IDXIMG_TAIL_LINES)
+    lines = [0]
+    def reader():
+        for raw in proc.stdout:
+            line = raw.decode("utf-8", "replace").rstrip()
+            if line:
+                tail.append(line)
+                lines[0] += 1
+                print_debug("[{}] {}".format(label, line), verbose=True)
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    reason = None
+    lastprogress = idxstart
+    try:
+        while True:
+            try:
+                proc.wait(timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            now = time.time()
+            if idximg_cancelled.is_set():
+                reason = "cancelled"
+            elif timeout and now - idxstart > timeout:
+                reason = "timed out after {}s".format(timeout)
+            if reason is not None:
+                kill_process_group(proc)
+                proc.wait()
+                break
+            if now - lastprogress >= IDXIMG_PROGRESS_INTERVAL:
+                lastprogress = now
+                print_debug(format_progress(label, lines[0], total, now - idxstart))
+    finally:
+        #closing the pipe while the reader still blocks on it would wait for that read, so a reader that is still
+        #stuck after a kill is left to finish on its own (it's a daemon thread)
+        thread.join(None if reason is None else 5)
+        if not thread.is_alive():
+            proc.stdout.close()
+        instrumentation.add("idximg {} {}".format(action.lower(), label), time.time() - idxstart)
+        instrumentation.add("idximg output lines", 0, files=lines[0])
+    if reason is not None:
+        raise Exception("{} {} for {}:\n{}".format(action, reason, label, "\n".join(tail)))
+    if proc.returncode != 0:
+        raise Exception("{} failed for {} (exit code {}):\n{}".format(action, label, proc.returncode, "\n".join(tail)))
+
+def kill_process_group(proc):
+    if os.name == "nt":
+        subprocess.call(["taskkill", "/F", "/T", "/PID", str(proc.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    proc.kill()
+
+def cancel_idximg(signum=None, frame=None):
+    #stops every running IdxImg and keeps queued ones from starting, then lets ctrl+c interrupt the main thread as usual
+    idximg_cancelled.set()
+    if signum is not None:
+        signal.default_int_handler(signum, frame)
+
+def patch_pkg(idxpath, pkgfile, modfolder, outdir, timeout=0):
+    #runs in a worker thread. every pkg gets its own output dir so concurrent patches never touch each others files
+    for folder in ["remastered", "original", "raw"]:
+        if not os.path.exists(os.path.join(modfolder, folder)):
+            os.makedirs(os.path.join(modfolder, folder))
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    idx_args = [idxpath, "hed", "patch", pkgfile, modfolder, "-o", outdir]
+    print_debug(idx_args, verbose=False)
+    total = sum(len(files) for root, dirs, files in os.walk(modfolder))
+    with io_slots:
+        run_idximg(idx_args, "Patch", os.path.basename(pkgfile), total, timeout)
+
+def temp_prefix(kind):
+    #temp folders carry the pid of the run that made them, see sweep_temp_dirs
+    return ".bridge_{}_{}_".format(kind, os.getpid())
+
+def pid_running(pid):
+    try:
+        import psutil
+        return psutil.pid_exists(pid)
+    except ImportError:
+        pass
+    if os.name == "nt":
+        #os.kill would terminate it on windows
+        output = subprocess.run(["tasklist", "/FI", "PID eq {}".format(pid), "/NH"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        return str(pid).encode("ascii") in output
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def sweep_temp_dirs(folder, kinds):
+    #temp folders left by a run that was killed or lost power, they can hold full size pkgs. the ones of a process
+    #that is still running are left alone, that includes this one since the other games of a batch may be using them
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        for kind in kinds:
+            prefix = ".bridge_{}_".format(kind)
+            if not name.startswith(prefix) or not os.path.isdir(os.path.join(folder, name)):
+                continue
+            pid = name[len(prefix):].split("_")[0]
+            if pid.isdigit() and (int(pid) == os.getpid() or pid_running(int(pid))):
+                continue
+            print_debug("Removing temp folder left by an interrupted run: {}".format(os.path.join(folder, name)))
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+def patch_output_dir(pkgdir, pkg):
+    #IdxImg writes the patched pkg straight into the game folder so installing it is a rename
+    try:
+        return tempfile.mkdtemp(prefix=temp_prefix("patch") + pkg + "_", dir=pkgdir)
+    except OSError as err:
+        raise Exception("Can't write to the game folder {}, the patched pkgs are installed there: {}".format(pkgdir, err))
+
+def install_file(src, dst):
+    #atomic rename over the old file, copies (to a temp file renamed into place) only when src is on another drive.
+    #returns how many bytes had to be copied
+    try:
+        os.replace(src, dst)
+        return 0
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    tmpfn = dst + ".tmp"
+    shutil.copy(src, tmpfn)
+    os.replace(tmpfn, dst)
+    os.remove(src)
+    return os.path.getsize(dst)
+
+def install_pkg(outdir, pkgdir, pkg):
+    #the .pkg goes first, a stale .hed pointing into a new .pkg is only possible between the two renames
+    copied = 0
+    for ext in [".pkg", ".hed"]:
+        copied += install_file(os.path.join(outdir, pkg+ext), os.path.join(pkgdir, pkg+ext))
+    return copied
+
+def write_subset_hed(hedfile, entries):
+    #IdxImg only ever reads the assets listed in the .hed, so a .hed with just the wanted entries next to a link to the
+    #untouched .pkg makes it extract only those. the temp dir is inside the game folder so hardlinking always works
+    pkgfile = hedfile[:-4]+".pkg"
+    tmpdir = tempfile.mkdtemp(prefix=temp_prefix("subset"), dir=os.path.dirname(hedfile))
+    subsetpkg = os.path.join(tmpdir, os.path.basename(pkgfile))
+    try:
+        os.link(pkgfile, subsetpkg)
+    except OSError:
+        os.symlink(os.path.abspath(pkgfile), subsetpkg)
+    subsethed = os.path.join(tmpdir, os.path.basename(hedfile))
+    with open(subsethed, "wb") as f:
+        for entry in entries:
+            f.write(HED_ENTRY.pack(*entry))
+    return tmpdir, subsethed
+
+def extract_pkg(idxpath, hedfile, outdir, validate_checksum, entries=None, timeout=0):
+    #runs in a worker thread, hashes the pkg and extracts it into its own staging dir. with entries only those hed
+    #entries are extracted
+    if not validChecksum(hedfile[:-4]+".pkg") and validate_checksum:
+        raise Exception("Error: {} has an invalid checksum, please restore the original file!".format(hedfile))
+    tmpdir = None
+    sourcehed = hedfile
+    if entries is not None:
+        tmpdir, sourcehed = write_subset_hed(hedfile, entries)
+    idx_args = [idxpath, "hed", "extract", sourcehed, "-o", outdir]
+    print_debug(idxpath, " hed", " extract", ' "{}"'.format(sourcehed), " -o", ' "{}"'.format(outdir))
+    #one line per hed entry
+    total = len(entries) if entries is not None else os.path.getsize(hedfile) // HED_ENTRY.size
+    try:
+        with io_slots:
+            run_idximg(idx_args, "Extract", os.path.basename(hedfile), total, timeout)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+def move_file(src, dst):
+    #rename when possible, copy when dst is on another drive. overwrites dst like the old shared extract folder did
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+        os.remove(src)
+
+def extracted_files(stagingdir):
+    #-> {path inside the extracted game: file in stagingdir}. original files go to the root, remastered ones keep
+    #their remastered folder
+    files = {}
+    for folder, prefix in [("original", ""), ("remastered", "remastered")]:
+        base = os.path.join(stagingdir, folder)
+        for root, dirs, filenames in os.walk(base):
+            for file in filenames:
+                fn = os.path.join(root, file)
+                files[os.path.join(prefix, os.path.relpath(fn, base))] = fn
+    return files
+
+def build_parser(gui=False):
     default_config = {
         "game": DEFAULTGAME,
         "mode": DEFAULTMODE,
@@ -223,7 +996,14 @@ def main(cli_args: list = []):
     if os.path.exists("config.json"):
         default_config = json.load(open("config.json"))
 
-    parser = GooeyParser()
+    if gui:
+        from gooey import GooeyParser
+        parser = GooeyParser()
+    else:
+        parser = argparse.ArgumentParser(description="Mod Manager Bridge")
+    #gooey widgets are only understood by GooeyParser
+    def widget(name):
+        return {"widget": name} if gui else {}
 
     main_options = parser.add_argument_group(
         "Main options",
@@ -237,8 +1017,9 @@ def main(cli_args: list = []):
             getmode = "fast_patch"
 
     main_options.add_argument("-game", choices=list(games.keys()), default=default_config.get("game"), help="Which game to operate on.", required=True)
-    main_options.add_argument("-mode", choices=["extract", "patch", "restore", "fast_patch", "fast_restore"], default=getmode, help="Which mode to run (`Patch` patches the game, `Extract` extracts the pkg files for the game, and `Restore` will restore the backed up pkg files without patching anything)", required=True)
+    main_options.add_argument("-mode", choices=["extract", "patch", "restore", "fast_patch", "fast_restore", "list", "analyze"], default=getmode, help="Which mode to run (`Patch` patches the game, `Extract` extracts the pkg files for the game, `Restore` will restore the backed up pkg files without patching anything, `List` lists the files in the pkgs without extracting them and `Analyze` reports mod and patch files that overwrite each other, are blacklisted or aren't in the pkgmap without patching anything)", required=True)
     #removed `uk` from region choices. uk just uses us for everything anyway aside from some journal stuff so it's not worth using ever and causes confusion in my opinion.
+    main_options.add_argument("-extractfilter", default="", help="(Optional) Only extract or list files matching these comma separated folders or patterns, for example `bgm\\` for music only or `bgm\\music1*.scd`")
     main_options.add_argument("-region", choices=["jp", "us", "it", "sp", "gr", "fr"], default=default_config.get("region", ""), help="defaults to 'us', needed to make sure the correct files are patched")
 
 
@@ -246,10 +1027,10 @@ def main(cli_args: list = []):
         "Setup",
         "Paths that must be configured to make sure the patcher works properly."
     )
-    main_options.add_argument("-openkh_path", help="Path to OpenKH folder.", default=default_config.get("openkh_path"), widget='DirChooser')
-    main_options.add_argument("-extracted_games_path", help="Path to folder containing extracted games", default=default_config.get("extracted_games_path"), widget='DirChooser')
-    main_options.add_argument("-khgame_path", help="Path to the Kingdom Hearts game install directory.", default=default_config.get("khgame_path"), widget='DirChooser')
-    main_options.add_argument("-patches_path", help="(Optional) Path to directory containing other kh2pcpatches to apply. Will be applied in alphabetical order (Mods Manager mods will be applied last).", default=default_config.get("patches_path"), widget='DirChooser')
+    main_options.add_argument("-openkh_path", help="Path to OpenKH folder.", default=default_config.get("openkh_path"), **widget('DirChooser'))
+    main_options.add_argument("-extracted_games_path", help="Path to folder containing extracted games", default=default_config.get("extracted_games_path"), **widget('DirChooser'))
+    main_options.add_argument("-khgame_path", help="Path to the Kingdom Hearts game install directory.", default=default_config.get("khgame_path"), **widget('DirChooser'))
+    main_options.add_argument("-patches_path", help="(Optional) Path to directory containing other kh2pcpatches to apply. Will be applied in alphabetical order (Mods Manager mods will be applied last).", default=default_config.get("patches_path"), **widget('DirChooser'))
 
 
     advanced_options = parser.add_argument_group(
@@ -259,244 +1040,851 @@ def main(cli_args: list = []):
     advanced_options.add_argument("-keepkhbuild", action="store_true", default=False, help="Will keep the intermediate khbuild folder from being deleted after the patch is applied")
     advanced_options.add_argument("-ignorebadchecksum", action="store_true", default=False, help="If true, disabled backing up and restoring the original PKG files based on checksums (you probably don't want to check this option)")
     advanced_options.add_argument('-failonmissing', action="store_true", default=False, help="If true, fails when a file can't be patched to a PKG, rather than printing a warning")
-    
-    # Parse and print the results
-    if cli_args:
-        args = parser.parse_args(cli_args)
-    else:
-        args = parser.parse_args()
+    advanced_options.add_argument("-fullrebuild", action="store_true", default=False, help="If true, restores and repatches every PKG that has mods even if its inputs didn't change since the last patch, and extract extracts every PKG again even if it didn't change since the last extract")
+    advanced_options.add_argument("-noplancache", action="store_true", default=False, help="If true, always rescans the mod folder and patches instead of reusing the cached patch plan")
+    advanced_options.add_argument("-games", default="", help="Run the mode for several games in one go, comma separated (for example `kh1,kh2,bbs`) or `all`. Overrides -game")
+    advanced_options.add_argument("-iolimit", type=int, default=None, help="How many disk heavy jobs (backups, restores, IdxImg runs, copying PKGs back) may run at the same time across all games (0 = no limit, default {} with -games and no limit otherwise)".format(BATCH_IOLIMIT))
+    advanced_options.add_argument("-watch", action="store_true", default=False, help="Keep running after patching and repatch the affected PKGs whenever the mod folder or the patches change (patch and fast_patch modes only)")
+    advanced_options.add_argument("-debounce", type=float, default=1.0, help="With -watch, how many seconds the mod folder has to stay unchanged before repatching")
+    advanced_options.add_argument("-stagemode", choices=["link", "copy"], default="link", help="How mod files are put into khbuild. `link` uses reflinks or hardlinks when khbuild is on the same drive as the mods and falls back to copying, `copy` always copies")
+    advanced_options.add_argument("-workers", type=int, default=0, help="How many PKGs to patch or extract at the same time (0 = one per CPU core)")
+    advanced_options.add_argument("-timeout", type=int, default=0, help="Stop an IdxImg extract or patch that runs longer than this many seconds and count its PKG as failed (0 = no limit)")
+    advanced_options.add_argument("-analysis", default="", help="With the analyze mode, also write every file with its source and PKGs, and all conflicts, to this JSON file", **widget('FileSaver'))
+    advanced_options.add_argument("-report", default="", help="Write a JSON report with the time, file, byte and syscall counts of every phase to this file", **widget('FileSaver'))
+    advanced_options.add_argument("-profile", default="", help="Write a cProfile dump of the run to this file (open it with pstats or snakeviz)", **widget('FileSaver'))
+    advanced_options.add_argument("-idxpath", default="", help="Use this IdxImg executable instead of the OpenKh.Command.IdxImg.exe in the OpenKH folder (used by benchmark.py)", **widget('FileChooser'))
+    return parser
 
-    config_to_write = {
-        "game": args.game,
-        "mode": args.mode,
-        "openkh_path": args.openkh_path,
-        "extracted_games_path": args.extracted_games_path,
-        "khgame_path": args.khgame_path,
-        "region": args.region,
-        "patches_path": args.patches_path,
-    }
-    json.dump(config_to_write, open("config.json", "w"))
+def parse_args(cli_args=None, gui=False):
+    #an empty cli_args means sys.argv, like main() always did
+    return build_parser(gui).parse_args(cli_args if cli_args else None)
 
+def resolve_paths(args):
+    #-> (game, PKGDIR, MODDIR, IDXPATH)
+    if not args.game in games:
+        raise Exception("Game not found, possible options: {}".format(list(games.keys())))
+    game = games[args.game](region=args.region)
+    PKGDIR = game.translate_pkg_path(os.path.join(args.khgame_path, "Image", "en"))
     MODDIR = os.path.join(args.openkh_path, "mod")
-    IDXDIR = args.openkh_path
-    IDXPATH = os.path.join(IDXDIR, "OpenKh.Command.IdxImg.exe")
+    IDXPATH = args.idxpath or os.path.join(args.openkh_path, "OpenKh.Command.IdxImg.exe")
+    return game, PKGDIR, MODDIR, IDXPATH
+
+class PatchPlan:
+    #everything a patch run decides from the mods, the extra patches and the pkgmap, worked out without touching the
+    #game files. staged maps pkg -> {path inside khbuild/<pkg>: mod file}, zipstaged maps pkg -> {path inside
+    #khbuild/<pkg>: [kh2pcpatch, member, crc32, size]} for the patch members that won. overwritten, unmapped,
+    #blacklisted and othergame hold what didn't make it, for the analyze mode
+    def __init__(self, game, region, mode):
+        self.game = game
+        self.region = region
+        self.mode = mode
+        self.staged = {}
+        self.zipstaged = {}
+        self.warnings = []
+        self.overwritten = []
+        self.unmapped = []
+        self.blacklisted = []
+        self.othergame = []
+    def pkgs(self):
+        return set(self.staged) | set(self.zipstaged)
+    def to_json(self):
+        return {"game": self.game, "region": self.region, "mode": self.mode, "staged": self.staged, "zipstaged": self.zipstaged, "warnings": self.warnings,
+                "overwritten": self.overwritten, "unmapped": self.unmapped, "blacklisted": self.blacklisted, "othergame": self.othergame}
+    @classmethod
+    def from_json(cls, data):
+        plan = cls(data["game"], data["region"], data["mode"])
+        plan.staged = data["staged"]
+        plan.zipstaged = data["zipstaged"]
+        plan.warnings = data["warnings"]
+        plan.overwritten = data.get("overwritten", [])
+        plan.unmapped = data.get("unmapped", [])
+        plan.blacklisted = data.get("blacklisted", [])
+        plan.othergame = data.get("othergame", [])
+        return plan
+    def save(self, path):
+        save_state(path, self.to_json())
+    @classmethod
+    def load(cls, path):
+        return cls.from_json(json.load(open(path)))
+
+def find_extra_patches(args):
+    extra_patches_dir = args.patches_path or ''
+    if extra_patches_dir and os.path.exists(extra_patches_dir):
+        return sorted(os.path.join(extra_patches_dir,p) for p in os.listdir(extra_patches_dir) if p.endswith(".kh2pcpatch")) #TODO double check extension
+    return []
 
+def patch_source(entry):
+    #how a kh2pcpatch member shows up in the analysis
+    return "{}:{}".format(os.path.basename(entry[0]), entry[1])
+
+def build_plan(args, pkgmap=None, snapshot=None):
+    #pkgmap and snapshot can be passed in by callers that keep them around between plans
+    game, PKGDIR, MODDIR, IDXPATH = resolve_paths(args)
     gamename = args.game
-    if not args.game in games:
-        raise Exception("Game not found, possible options: {}".format(list(games.keys())))
-    region = args.region
-    game = games[gamename](region=region)
+    plan = PatchPlan(args.game, args.region, args.mode)
+    if args.mode not in ["patch", "fast_patch", "analyze"]:
+        return plan
+    fastpatch = args.mode == "fast_patch"
+    analyze = args.mode == "analyze"
+    #the analyzer wants to see every problem, not stop at the first one
+    ignoremissing = analyze or not args.failonmissing
+    if pkgmap is None:
+        instrumentation.start("pkgmap_load")
+        pkgmap = PkgMapIndex.open(game.name) # pkgmap.json with the extras and blacklist already applied
 
-    PKGDIR = game.translate_pkg_path(os.path.join(args.khgame_path, "Image", "en"))
+    instrumentation.start("mod_walk")
+    staged = plan.staged
+    if snapshot is None:
+        snapshot = ModTreeSnapshot(MODDIR)
+    for fn, relfn in snapshot.files.items():
+        relfn_trans = game.translate_path(relfn, snapshot)
+        print_debug("Translated Filename: {}".format(relfn_trans), verbose=True)
+        #raw paths are the exact same as original paths, just with the root flder being "raw" instead of "original"
+        #so we can check against the original path instead of needing to update the pkgmap.
+        if "raw"+os.sep in relfn_trans:
+            pkgs = pkgmap.get(relfn_trans.replace("raw"+os.sep, ""), "")
+        else:
+            pkgs = pkgmap.get(relfn_trans, "")
+        pkgsblk = pkgmap.blacklisted(relfn_trans)
+        if not pkgs:
+            plan.unmapped.append({"path": relfn_trans.replace(os.sep, "/"), "source": fn})
+            plan.warnings.append("WARNING: Could not find which pkg this path belongs, file not patched: {} (original path {})".format(relfn_trans, relfn))
+            if not ignoremissing:
+                print_debug(plan.warnings[-1])
+                raise Exception("Exiting due to warning")
+            continue
+        if pkgsblk:
+            plan.blacklisted.append({"path": relfn_trans.replace(os.sep, "/"), "source": fn, "pkgs": pkgsblk})
+            plan.warnings.append("WARNING: File blacklisted, file not patched: {})".format(relfn_trans))
+            if not ignoremissing:
+                print_debug(plan.warnings[-1])
+                raise Exception("Exiting due to warning")
+            continue
+        for pkg in pkgs:
+            #only patch if the file does not exist in the blacklist pkgmap.
+            if pkg not in pkgsblk:
+                #default
+                pkgname = pkg
+                #fast_patch forces the pkg name to be the first PKG for all file, if the 
+                #gamename isn't Recom or Movies as those are only in a single PKG anyway.
+                if fastpatch:
+                    if gamename not in ["Recom", "Movies"]:
+                        pkgname = gamename + "_first"
+                #"remastered" and "raw" paths are always already in their own folders 
+                #so no need to add the folder name to the newfn path.
+                if "remastered"+os.sep in relfn_trans or "raw"+os.sep in relfn_trans:
+                    newfn = relfn_trans
+                else:
+                    newfn = os.path.join("original", relfn_trans)
+                previous = staged.setdefault(pkgname, {}).get(newfn)
+                if previous is not None and previous != fn:
+                    plan.overwritten.append({"pkg": pkgname, "path": newfn.replace(os.sep, "/"), "winner": fn, "overridden": previous})
+                staged[pkgname][newfn] = fn
+
+    instrumentation.start("zip_merge")
+    #only the central directories are read here, later patches win over earlier ones
+    zipped_files = {}
+    for patch in find_extra_patches(args):
+        with ZipFile(patch) as input_zip:
+            for info in input_zip.infolist():
+                entry = [patch, info.filename, info.CRC, info.file_size]
+                if info.filename in zipped_files and info.file_size:
+                    pkgname, _, newfn = info.filename.partition("/")
+                    plan.overwritten.append({"pkg": pkgname, "path": newfn, "winner": patch_source(entry), "overridden": patch_source(zipped_files[info.filename])})
+                zipped_files[info.filename] = entry
+    gamepkgs = [p.split(".pkg")[0] for p in game.pkgs]
+    for fn in zipped_files:
+        if zipped_files[fn][3] == 0:
+            continue
+        #a kh2pcpatch can carry files for other games, those are left for the run of that game
+        if fn.split("/")[0] not in gamepkgs:
+            plan.othergame.append(patch_source(zipped_files[fn]))
+            print_debug("Skipping patch file for another game: {}".format(fn), verbose=True)
+            continue
+        #default
+        fastfn = fn
+        #extract all kh2pcpatch files to the first PKG if fast_patch is used.
+        if fastpatch:
+            if gamename not in ["Recom", "Movies"]:
+                if "/original/" in fn:
+                    fastfn = gamename+"_first/original/"+fn.split("/original/")[1]
+                elif "/remastered/" in fn:
+                    fastfn = gamename+"_first/remastered/"+fn.split("/remastered/")[1]
+                elif "/raw/" in fn:
+                    fastfn = gamename+"_first/raw/"+fn.split("/raw/")[1]
+        pkgname, _, newfn = fastfn.partition("/")
+        if analyze:
+            #patches name their pkg themselves, flag the files that pkg doesn't have or has blacklisted according to
+            #the pkgmap. they're still patched like before, this only reports them
+            folder, _, assetpath = newfn.partition("/")
+            mappath = newfn if folder == "remastered" else assetpath
+            if pkgname not in pkgmap.get(mappath, ""):
+                plan.unmapped.append({"path": newfn, "source": patch_source(zipped_files[fn]), "pkg": pkgname})
+            pkgsblk = pkgmap.blacklisted(mappath)
+            if pkgname in pkgsblk:
+                plan.blacklisted.append({"path": newfn, "source": patch_source(zipped_files[fn]), "pkgs": pkgsblk})
+        newfn = newfn.replace("/", os.sep)
+        # mods manager needs to take priority
+        if newfn not in staged.get(pkgname, {}):
+            previous = plan.zipstaged.get(pkgname, {}).get(newfn)
+            if previous is not None:
+                plan.overwritten.append({"pkg": pkgname, "path": newfn.replace(os.sep, "/"), "winner": patch_source(zipped_files[fn]), "overridden": patch_source(previous)})
+            plan.zipstaged.setdefault(pkgname, {})[newfn] = zipped_files[fn]
+        else:
+            plan.overwritten.append({"pkg": pkgname, "path": newfn.replace(os.sep, "/"), "winner": staged[pkgname][newfn], "overridden": patch_source(zipped_files[fn])})
+    return plan
+
+PLAN_CACHE_DIR = "plan_cache"
+#bump when build_plan changes how it maps, translates or prioritizes files, so plans cached by older versions are rebuilt
+PLAN_CACHE_VERSION = 2
+
+def tree_signature(path):
+    #mtimes of every directory below path. adding, removing or renaming a file changes at least one of them, which is
+    #all a plan depends on, and it costs one stat per directory instead of one per file
+    sig = hashlib.md5()
+    if not os.path.exists(path):
+        return None
+    stack = [path]
+    while stack:
+        d = stack.pop()
+        sig.update("{}:{}\n".format(d, os.stat(d).st_mtime_ns).encode("utf-8"))
+        stack += sorted(e.path for e in os.scandir(d) if e.is_dir())
+    return sig.hexdigest()
+
+def plan_fingerprint(args):
+    game, PKGDIR, MODDIR, IDXPATH = resolve_paths(args)
+    patches = []
+    for patch in find_extra_patches(args):
+        st = os.stat(patch)
+        patches.append([patch, st.st_size, st.st_mtime_ns])
+    return hashlib.md5(json.dumps([
+        PLAN_CACHE_VERSION, args.game, args.region, args.mode, args.failonmissing, os.path.abspath(MODDIR), tree_signature(MODDIR), patches, pkgmap_sources_signature()
+    ]).encode("utf-8")).hexdigest()
+
+def load_plan(args):
+    #reuses the last plan for this game as long as the mod folder layout, the extra patches and the pkgmaps are the same
+    fingerprint = plan_fingerprint(args)
+    cachefn = os.path.join(PLAN_CACHE_DIR, args.game + ".json")
+    cached = load_state(cachefn)
+    if cached.get("version") == PLAN_CACHE_VERSION and cached.get("fingerprint") == fingerprint:
+        print_debug("Using cached patch plan", verbose=True)
+        return PatchPlan.from_json(cached["plan"])
+    plan = build_plan(args)
+    if not os.path.exists(PLAN_CACHE_DIR):
+        os.makedirs(PLAN_CACHE_DIR)
+    save_state(cachefn, {"version": PLAN_CACHE_VERSION, "fingerprint": fingerprint, "plan": plan.to_json()})
+    return plan
 
+def analyze_plan(plan, analysisfn=""):
+    #every asset path that ends up in a pkg with the source that wins for it, plus everything that gets overwritten,
+    #is blacklisted, isn't in the pkgmap or belongs to another game. needs only the plan, so it runs in well under a
+    #second even for big mod stacks
+    instrumentation.start("analyze")
+    #asset path -> {pkg: winning source}
+    assets = {}
+    for pkgname, files in plan.staged.items():
+        for newfn, fn in files.items():
+            assets.setdefault(newfn.replace(os.sep, "/"), {})[pkgname] = fn
+    for pkgname, files in plan.zipstaged.items():
+        for newfn, entry in files.items():
+            assets.setdefault(newfn.replace(os.sep, "/"), {})[pkgname] = patch_source(entry)
+    for entry in plan.overwritten:
+        print_debug("OVERWRITTEN: {}/{}: {} wins over {}".format(entry["pkg"], entry["path"], entry["winner"], entry["overridden"]))
+    for entry in plan.blacklisted:
+        print_debug("BLACKLISTED: {} from {} (blacklisted in {})".format(entry["path"], entry["source"], ", ".join(entry["pkgs"])))
+    for entry in plan.unmapped:
+        if "pkg" in entry:
+            print_debug("UNMAPPED: {} from {} is not in {} according to the pkgmap".format(entry["path"], entry["source"], entry["pkg"]))
+        else:
+            print_debug("UNMAPPED: {} from {} is not in any pkg".format(entry["path"], entry["source"]))
+    print_debug("Analysis of {}: {} files into {} pkgs, {} overwritten, {} blacklisted, {} unmapped, {} patch files for other games".format(
+        plan.game, len(assets), len(plan.pkgs()), len(plan.overwritten), len(plan.blacklisted), len(plan.unmapped), len(plan.othergame)))
+    if analysisfn:
+        save_game_state(analysisfn, plan.game, {
+            "assets": assets,
+            "overwritten": plan.overwritten,
+            "blacklisted": plan.blacklisted,
+            "unmapped": plan.unmapped,
+            "othergame": plan.othergame,
+        })
+
+def list_pkgs(game, PKGDIR, patterns=""):
+    #prints the named files of every pkg of the game straight from the .hed files, nothing gets extracted
+    pkgmap = PkgMapIndex.open(game.name)
+    try:
+        for pkg in game.pkgs:
+            hedfile = os.path.join(PKGDIR, pkg.split(".pkg")[0]+".hed")
+            if not os.path.exists(hedfile):
+                continue
+            assets = list_assets(pkgmap, hedfile, patterns)
+            total = 0
+            for name, (md5, offset, datalength, actuallength) in assets:
+                print("{}\t{}\t{}".format(pkg[:-4], name, actuallength))
+                total += actuallength
+            print_debug("{}: {} files, {} MB".format(pkg[:-4], len(assets), round(total / (1024*1024), 2)))
+    finally:
+        pkgmap.close()
+
+state_lock = threading.Lock()
+
+def save_game_state(path, gamename, game_state):
+    #only replaces the entry of this game, so games of a batch that finish at different times don't undo each other
+    with state_lock:
+        state = load_state(path)
+        state[gamename] = game_state
+        save_state(path, state)
+
+def execute_plan(plan, args, pool=None, backup_store=None):
+    #pool and backup_store are shared between the games of a batch, a single game run makes its own
+    game, PKGDIR, MODDIR, IDXPATH = resolve_paths(args)
+
+    mode = plan.mode
+    if mode == "analyze":
+        analyze_plan(plan, args.analysis)
+        return
     if not os.path.exists(PKGDIR):
         raise Exception("PKG dir not found")
+    if mode == "list":
+        list_pkgs(game, PKGDIR, args.extractfilter)
+        return
+    sweep_temp_dirs(PKGDIR, ["patch", "subset"])
+    if args.extracted_games_path:
+        sweep_temp_dirs(args.extracted_games_path, ["extract"])
     if not os.path.exists(IDXPATH):
-        raise Exception("OpenKh.Command.IdxImg.exe not found")
+        raise Exception("OpenKh.Command.IdxImg.exe not found: {}".format(IDXPATH))
 
-    mode = args.mode
     patch = True if mode in ["patch", "fast_patch"] else False
-    fastpatch = True if mode == "fast_patch" else False
     extract = True if mode == "extract" else False
 
-    extra_patches_dir = args.patches_path or ''
-
     keepkhbuild = args.keepkhbuild
     validate_checksum = args.ignorebadchecksum
-    ignoremissing = not args.failonmissing
 
     backup = True if mode in ["patch", "fast_patch"] else False
     restore = True if mode in ["patch", "restore", "fast_patch", "fast_restore"] else False
-    fastrestore = True if mode in ["fast_patch", "fast_restore"] else False
 
-    pkgmap = json.load(open("pkgmap.json")).get(game.name, {})
-    pkgmap_extras = json.load(open("pkgmap_extras.json")).get(game.name, {}) # predefined extras for patches that fail otherwise, such as GOA ROM
-    pkgmap_blacklist = json.load(open("pkgmap_blacklist.json")).get(game.name, {}) # blacklist of bad files to replace
-    pkgmap.update(pkgmap_extras)
+    for warning in plan.warnings:
+        print_debug(warning)
 
     if extract:
+        instrumentation.start("extract")
         print_debug("Extracting {}".format(game.name))
         if not os.path.exists(args.extracted_games_path):
             raise Exception("Path does not exist to extract games to! {}".format(args.extracted_games_path))
         print(game.name)
-        pkglist = [os.path.join(PKGDIR,p) for p in os.listdir(PKGDIR) if game.name.lower() in p.lower() and p.endswith(".hed")]
-        if os.path.exists("extractedout"):
-            shutil.rmtree("extractedout")
-        os.makedirs("extractedout")
+        #sorted, files that exist in several pkgs always come from the last one
+        pkglist = sorted(os.path.join(PKGDIR,p) for p in os.listdir(PKGDIR) if game.name.lower() in p.lower() and p.endswith(".hed"))
+        order = [os.path.basename(pkgfile)[:-4] for pkgfile in pkglist]
         EXTRACTED_GAME_PATH = os.path.join(args.extracted_games_path, game.name)
         if EXTRACTED_GAME_PATH.endswith("kh3d"):
             EXTRACTED_GAME_PATH = EXTRACTED_GAME_PATH.replace("kh3d", "ddd")
         print(EXTRACTED_GAME_PATH)
-        if os.path.exists(EXTRACTED_GAME_PATH):
-            shutil.rmtree(EXTRACTED_GAME_PATH)
-        print_debug(pkglist, verbose=True)
-        for pkgfile in pkglist:
-            if not validChecksum(pkgfile[:-4]+".pkg") and validate_checksum:
-                raise Exception("Error: {} has an invalid checksum, please restore the original file!".format(pkgfile))
-            idx_args = [IDXPATH, "hed", "extract", pkgfile, "-o", "extractedout"]
-            print_debug(IDXPATH, "hed", "extract", '"{}"'.format(pkgfile), "-o", '"{}"'.format("extractedout"))
+        selected = {}
+        game_extract = None
+        if args.extractfilter:
+            #only the matching assets get extracted, on top of whatever was extracted before
+            pkgmap = PkgMapIndex.open(game.name)
+            for pkgfile in pkglist:
+                selected[pkgfile] = [entry for name, entry in list_assets(pkgmap, pkgfile, args.extractfilter)]
+                print_debug("{}: {} matching files".format(os.path.basename(pkgfile)[:-4], len(selected[pkgfile])))
+            pkgmap.close()
+            pkglist = [pkgfile for pkgfile in pkglist if selected[pkgfile]]
+        else:
+            #only pkgs whose .hed or .pkg changed since they were last extracted to this folder get extracted again
+            game_extract = load_state(EXTRACT_MANIFEST_PATH).get(game.name, {})
+            if args.fullrebuild or game_extract.get("path") != os.path.abspath(EXTRACTED_GAME_PATH) or not os.path.exists(EXTRACTED_GAME_PATH):
+                game_extract = {"path": os.path.abspath(EXTRACTED_GAME_PATH), "pkgs": {}}
+                if os.path.exists(EXTRACTED_GAME_PATH):
+                    shutil.rmtree(EXTRACTED_GAME_PATH)
+            checksums_pool = pool or ThreadPoolExecutor(max_workers=resolve_workers(args.workers, len(pkglist)))
             try:
-                output = subprocess.check_output(idx_args, stderr=subprocess.STDOUT)
-                print_debug(output, verbose=True)
-            except subprocess.CalledProcessError as err:
-                output = err.output
-                print_debug(output.decode('utf-8'))
-                raise Exception("Extract failed")
-        original_path = os.path.join("extractedout", "original")
-        remastered_path = os.path.join("extractedout", "remastered")
-        if os.path.exists(remastered_path):
-            shutil.move(remastered_path, os.path.join(original_path, "remastered"))
-        shutil.move(original_path, args.extracted_games_path)
-        os.rename(os.path.join(args.extracted_games_path, "original"), EXTRACTED_GAME_PATH)
+                pkgchecksums = {pkgname: [checksums_pool.submit(get_checksum_cache().md5, os.path.join(PKGDIR, pkgname+ext)) for ext in [".hed", ".pkg"]] for pkgname in order}
+                pkgchecksums = {pkgname: [future.result() for future in futures] for pkgname, futures in pkgchecksums.items()}
+            finally:
+                if pool is None:
+                    checksums_pool.shutdown()
+            for pkgname in order:
+                if game_extract["pkgs"].get(pkgname, {}).get("checksums") == pkgchecksums[pkgname]:
+                    print_debug("Unchanged since last extract, skipping: {}".format(pkgname))
+            pkglist = [pkgfile for pkgfile, pkgname in zip(pkglist, order) if game_extract["pkgs"].get(pkgname, {}).get("checksums") != pkgchecksums[pkgname]]
+        print_debug(pkglist, verbose=True)
+        if not os.path.exists(EXTRACTED_GAME_PATH):
+            os.makedirs(EXTRACTED_GAME_PATH)
+        #IdxImg extracts next to the final folder, so putting its files in place is a rename and never a copy
+        stagingroot = tempfile.mkdtemp(prefix=temp_prefix("extract"), dir=args.extracted_games_path)
+        try:
+            #the files each pkg has in EXTRACTED_GAME_PATH right now, pkgs that weren't extracted again keep their old list
+            current = {}
+            if game_extract is not None:
+                current = {pkgname: set(entry["files"]) for pkgname, entry in game_extract["pkgs"].items() if pkgname in order}
+            extracted = set()
+            newfiles = {}
+            while pkglist:
+                stagingdirs = {os.path.basename(pkgfile)[:-4]: os.path.join(stagingroot, os.path.basename(pkgfile)[:-4]) for pkgfile in pkglist}
+                failed = []
+                extractpool = pool or ThreadPoolExecutor(max_workers=resolve_workers(args.workers, len(pkglist)))
+                try:
+                    futures = {extractpool.submit(extract_pkg, IDXPATH, pkgfile, stagingdirs[os.path.basename(pkgfile)[:-4]], validate_checksum, selected.get(pkgfile), args.timeout): pkgfile for pkgfile in pkglist}
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                        except Exception as err:
+                            print(err)
+                            failed.append(os.path.basename(futures[future]))
+                finally:
+                    if pool is None:
+                        extractpool.shutdown()
+                if failed:
+                    raise Exception("Extract failed for: {}".format(", ".join(sorted(failed))))
+                for i, pkgname in enumerate(order):
+                    if pkgname not in stagingdirs:
+                        continue
+                    newfiles[pkgname] = extracted_files(stagingdirs[pkgname])
+                    #a later pkg that wasn't extracted in this round still wins for the files they share
+                    later = set().union(*[current.get(other, ()) for other in order[i+1:] if other not in stagingdirs])
+                    for rel, fn in newfiles[pkgname].items():
+                        if rel in later:
+                            continue
+                        dst = os.path.join(EXTRACTED_GAME_PATH, rel)
+                        if not os.path.exists(os.path.dirname(dst)):
+                            os.makedirs(os.path.dirname(dst))
+                        move_file(fn, dst)
+                    current[pkgname] = set(newfiles[pkgname])
+                pkglist = []
+                if game_extract is not None and not extracted:
+                    #a changed or removed pkg that no longer has a file leaves its old copy on disk. when an earlier pkg
+                    #that wasn't extracted again also has it, that pkg wins now and gets extracted in a second round
+                    again = set()
+                    for pkgname, entry in game_extract["pkgs"].items():
+                        if pkgname in order and pkgname not in stagingdirs:
+                            continue
+                        for rel in set(entry["files"]) - set(newfiles.get(pkgname, ())):
+                            winner = None
+                            for other in order:
+                                if rel in current.get(other, ()):
+                                    winner = other
+                            if winner is not None and winner not in stagingdirs and (pkgname not in order or order.index(winner) < order.index(pkgname)):
+                                again.add(winner)
+                    for pkgname in sorted(again):
+                        print_debug("Extracting again, it has files a changed pkg no longer has: {}".format(pkgname))
+                    pkglist = [os.path.join(PKGDIR, pkgname+".hed") for pkgname in order if pkgname in again]
+                extracted.update(stagingdirs)
+        finally:
+            shutil.rmtree(stagingroot, ignore_errors=True)
+        if game_extract is not None:
+            #files that the changed or removed pkgs no longer have
+            stale = set()
+            for pkgname in list(game_extract["pkgs"]):
+                if pkgname in newfiles or pkgname not in order:
+                    stale.update(game_extract["pkgs"][pkgname]["files"])
+                if pkgname not in order:
+                    del game_extract["pkgs"][pkgname]
+            for pkgname in newfiles:
+                game_extract["pkgs"][pkgname] = {"checksums": pkgchecksums[pkgname], "files": sorted(newfiles[pkgname])}
+            stale -= set().union(*[set(entry["files"]) for entry in game_extract["pkgs"].values()])
+            for rel in stale:
+                if os.path.exists(os.path.join(EXTRACTED_GAME_PATH, rel)):
+                    os.remove(os.path.join(EXTRACTED_GAME_PATH, rel))
+            save_game_state(EXTRACT_MANIFEST_PATH, game.name, game_extract)
+    if backup_store is None:
+        backup_store = BackupStore()
+        if os.path.exists("backup_pkgs"):
+            backup_store.import_legacy("backup_pkgs")
     if backup:
-        if not os.path.exists("backup_pkgs"):
-            os.makedirs("backup_pkgs")
+        instrumentation.start("backup")
         for pkg in game.pkgs:
-            sourcefn = os.path.join(PKGDIR, pkg)
-            newfn = os.path.join("backup_pkgs", pkg)
-            if not os.path.exists(newfn):
+            for name in [pkg, pkg.split(".pkg")[0]+".hed"]:
+                if backup_store.md5(name) is not None:
+                    continue
+                sourcefn = os.path.join(PKGDIR, name)
                 print_debug("Backing up file: " + sourcefn)
-                if not validChecksum(sourcefn) and validate_checksum :
+                #validated against the md5 the copy computes, so the pkg is only read once
+                with io_slots:
+                    checksum = backup_store.add(name, sourcefn)
+                get_checksum_cache().remember(sourcefn, checksum)
+                if name.endswith(".pkg") and validate_checksum and not validChecksum(sourcefn, checksum):
+                    backup_store.remove(name)
                     raise Exception("Error: {} has an invalid checksum, please restore the original file and try again".format(sourcefn))
-                shutil.copy(sourcefn, newfn)
-                shutil.copy(sourcefn.split(".pkg")[0]+".hed", newfn.split(".pkg")[0]+".hed")
+    game_manifest = load_state(BUILD_MANIFEST_PATH).get(game.name, {})
+    #pkgs this game has modified and their signature right after, restore only ever looks at these
+    journal = load_state(STATE_JOURNAL_PATH)
+    legacy = game.name not in journal
+    dirty = journal.get(game.name, {})
+    unchanged = set()
+    wanted = set()
+    if patch:
+        staged = plan.staged
+        zipstaged = plan.zipstaged
+        wanted = plan.pkgs()
+        #a pkg only needs to be restored and repatched when its inputs, its original hed or the installed files changed
+        instrumentation.start("manifest")
+        for pkgname in wanted:
+            inputs = {}
+            for newfn, fn in staged.get(pkgname, {}).items():
+                inputs[newfn] = get_checksum_cache().md5(fn)
+            for newfn, (patchfile, member, crc, size) in zipstaged.get(pkgname, {}).items():
+                inputs[newfn] = "crc32:{:08x}:{}".format(crc, size)
+            new_entry = {
+                "inputs": inputs,
+                "base": backup_store.md5(pkgname+".hed")
+            }
+            old_entry = game_manifest.get(pkgname)
+            if not args.fullrebuild and old_entry is not None and old_entry["inputs"] == new_entry["inputs"] and old_entry["base"] == new_entry["base"] and old_entry.get("installed") == pkg_signature(PKGDIR, pkgname):
+                print_debug("Unchanged since last patch, skipping: {}".format(pkgname))
+                unchanged.add(pkgname)
+            else:
+                game_manifest[pkgname] = new_entry
     if restore:
+        instrumentation.start("restore")
         print_debug("Restoring from backup")
-        if not os.path.exists("backup_pkgs"):
-            raise Exception("Backup folder doesn't exist")
-        if fastrestore:
-            if gamename != "Recom" or gamename != "Movies":
-                pkgname = gamename + "_first.pkg"
-                newfn = os.path.join(PKGDIR, pkgname)
-                sourcefn = os.path.join("backup_pkgs", pkgname)
-                if validChecksum(newfn.split(".pkg")[0]+".hed"):
-                    pass
-                else:
-                    print("Restoring {}".format(pkgname))
-                    shutil.copy(sourcefn, newfn)
-                    shutil.copy(sourcefn.split(".pkg")[0]+".hed", newfn.split(".pkg")[0]+".hed")
-        else:
+        if legacy:
+            #first run with the journal, find the pkgs an older version patched by hashing the .hed files once
             for pkg in game.pkgs:
-                newfn = os.path.join(PKGDIR, pkg)
-                sourcefn = os.path.join("backup_pkgs", pkg)
-                if validChecksum(newfn.split(".pkg")[0]+".hed"):
-                    continue
-                else:
-                    print("Restoring {}".format(pkg))
-                    shutil.copy(sourcefn, newfn)
-                    shutil.copy(sourcefn.split(".pkg")[0]+".hed", newfn.split(".pkg")[0]+".hed")
+                hedname = pkg.split(".pkg")[0]+".hed"
+                if backup_store.md5(hedname) is not None and get_checksum_cache().md5(os.path.join(PKGDIR, hedname)) != backup_store.md5(hedname):
+                    dirty[pkg[:-4]] = None
+        for pkgname in sorted(dirty):
+            if pkgname in unchanged:
+                continue
+            if dirty[pkgname] is not None and pkg_signature(PKGDIR, pkgname) != dirty[pkgname]:
+                print_debug("WARNING: {} was changed outside of the bridge since it was patched, restoring it anyway".format(pkgname))
+            print("Restoring {}".format(pkgname+".pkg"))
+            with io_slots:
+                written = backup_store.restore(pkgname+".pkg", os.path.join(PKGDIR, pkgname+".pkg"))
+                written += backup_store.restore(pkgname+".hed", os.path.join(PKGDIR, pkgname+".hed"))
+            print_debug("Restored {}, rewrote {} MB".format(pkgname+".pkg", round(written / (1024*1024), 2)), verbose=True)
+            del dirty[pkgname]
+            save_game_state(STATE_JOURNAL_PATH, game.name, dirty)
+            if not patch:
+                game_manifest.pop(pkgname, None)
+        save_game_state(STATE_JOURNAL_PATH, game.name, dirty)
     if patch:
+        instrumentation.start("staging")
         print_debug("Patching")
-        if os.path.exists("khbuild"):
-            shutil.rmtree("khbuild")
-        os.makedirs("khbuild")
-        if os.path.exists(MODDIR):
-            for root, dirs, files in os.walk(MODDIR):
-                path = root.split(os.sep)
-                for file in files:
-                    fn = os.path.join(root, file)
-                    relfn = fn.replace(MODDIR, '')
-                    relfn_trans = game.translate_path(relfn, MODDIR)
-                    print_debug("Translated Filename: {}".format(relfn_trans), verbose=True)
-                    #raw paths are the exact same as original paths, just with the root flder being "raw" instead of "original"
-                    #so we can check against the original path instead of needing to update the pkgmap.
-                    if "raw"+os.sep in relfn_trans:
-                        pkgs = pkgmap.get(relfn_trans.replace("raw"+os.sep, ""), "")
-                    else:
-                        pkgs = pkgmap.get(relfn_trans, "")
-                    pkgsblk = pkgmap_blacklist.get(relfn_trans, "")
-                    if not pkgs:
-                        print_debug("WARNING: Could not find which pkg this path belongs, file not patched: {} (original path {})".format(relfn_trans, relfn))
-                        if not ignoremissing:
-                            raise Exception("Exiting due to warning")
-                        continue
-                    if pkgsblk:
-                        print_debug("WARNING: File blacklisted, file not patched: {})".format(relfn_trans))
-                        if not ignoremissing:
-                            raise Exception("Exiting due to warning")
-                        continue
-                    for pkg in pkgs:
-                        #only patch if the file does not exist in the blacklist pkgmap.
-                        if pkg not in pkgsblk:
-                            #default
-                            pkgname = pkg
-                            #fast_patch forces the pkg name to be the first PKG for all file, if the 
-                            #gamename isn't Recom or Movies as those are only in a single PKG anyway.
-                            if fastpatch:
-                                if gamename != "Recom" or gamename != "Movies":
-                                    pkgname = gamename + "_first"
-                            #"remastered" and "raw" paths are always already in their own folders 
-                            #so no need to add the folder name to the newfn path.
-                            if "remastered"+os.sep in relfn_trans or "raw"+os.sep in relfn_trans:
-                                newfn = os.path.join("khbuild", pkgname, relfn_trans)
-                            else:
-                                newfn = os.path.join("khbuild", pkgname, "original", relfn_trans)
-                            new_basedir = os.path.dirname(newfn)
-                            if not os.path.exists(new_basedir):
-                                os.makedirs(new_basedir)
-                            shutil.copy(fn, newfn)
-        other_patches = []
-        if extra_patches_dir and os.path.exists(extra_patches_dir):
-            other_patches = [os.path.join(extra_patches_dir,p) for p in os.listdir(extra_patches_dir) if p.endswith(".kh2pcpatch")] #TODO double check extension
-        zipped_files = {}
-        for patch in sorted(other_patches):
-            # Read the patch in as a zip, or extract it out to some temp dir
-            # copy the files in based on the pkgmap
-            input_zip=ZipFile(patch)
-            for name in input_zip.namelist():
-                zipped_files[name] = input_zip.read(name)
-        for fn in zipped_files:
-            if len(zipped_files[fn]) == 0:
+        #only this game's pkgs, the other games of a batch may be building next to it
+        for pkg in set(p[:-4] for p in game.pkgs) | wanted:
+            if os.path.exists(os.path.join("khbuild", pkg)):
+                shutil.rmtree(os.path.join("khbuild", pkg))
+        #pkgs that had mods last time but none now were restored above and no longer have a build
+        for pkgname in list(game_manifest):
+            if pkgname not in wanted:
+                del game_manifest[pkgname]
+        stager = Stager(args.stagemode)
+        open_zips = {}
+        for pkgname in wanted:
+            if pkgname in unchanged:
                 continue
-            #default
-            fastfn = fn
-            #extract all kh2pcpatch files to the first PKG if fast_patch is used.
-            if fastpatch:
-                if gamename != "Recom" or gamename != "Movies":
-                    if "/original/" in fn:
-                        fastfn = gamename+"_first/original/"+fn.split("/original/")[1]
-                    elif "/remastered/" in fn:
-                        fastfn = gamename+"_first/remastered/"+fn.split("/remastered/")[1]
-                    elif "/raw/" in fn:
-                        fastfn = gamename+"_first/raw/"+fn.split("/raw/")[1]
-            newfn = os.path.join("khbuild", fastfn)
-            # mods manager needs to take priority
-            if not os.path.exists(newfn): 
+            for newfn, fn in staged.get(pkgname, {}).items():
+                newfn = os.path.join("khbuild", pkgname, newfn)
                 new_basedir = os.path.dirname(newfn)
                 if not os.path.exists(new_basedir):
                     os.makedirs(new_basedir)
-                open(newfn, "wb").write(zipped_files[fn])
-        for pkg in os.listdir("khbuild"):
-            pkgfile = os.path.join(PKGDIR, pkg+".pkg")
-            modfolder = os.path.join("khbuild", pkg)
-            if not os.path.exists(os.path.join(modfolder, "remastered")):
-                os.makedirs(os.path.join(modfolder, "remastered"))
-            if not os.path.exists(os.path.join(modfolder, "original")):
-                os.makedirs(os.path.join(modfolder, "original"))
-            if not os.path.exists(os.path.join(modfolder, "raw")):
-                os.makedirs(os.path.join(modfolder, "raw"))
-            if os.path.exists("pkgoutput"):
-                shutil.rmtree("pkgoutput")
-            print_debug("Patching: {}".format(pkg))
-            args = [IDXPATH, "hed", "patch", pkgfile, modfolder, "-o", "pkgoutput"]
-            #print_debug(IDXPATH, "hed", "patch", '"{}"'.format(pkgfile), '"modfolder"', "-o", '"{}"'.format("pkgoutput"))
-            try:
-                print_debug(args, verbose=False)
-                output = subprocess.check_output(args, stderr=subprocess.STDOUT).decode('utf-8').replace("\n", "")
-                print_debug(output, verbose=True)
-            except subprocess.CalledProcessError as err:
-                output = err.output
-                print(output.decode('utf-8'))
-                raise Exception("Patch failed")
-            shutil.copy(os.path.join("pkgoutput", pkg+".pkg"), os.path.join(PKGDIR, pkg+".pkg"))
-            shutil.copy(os.path.join("pkgoutput", pkg+".hed"), os.path.join(PKGDIR, pkg+".hed"))
+                stager.stage(fn, newfn)
+            for newfn, (patchfile, member, crc, size) in zipstaged.get(pkgname, {}).items():
+                newfn = os.path.join("khbuild", pkgname, newfn)
+                new_basedir = os.path.dirname(newfn)
+                if not os.path.exists(new_basedir):
+                    os.makedirs(new_basedir)
+                #stream only the winning members straight from the archive
+                if patchfile not in open_zips:
+                    open_zips[patchfile] = ZipFile(patchfile)
+                with open_zips[patchfile].open(member) as src, open(newfn, "wb") as dst:
+                    shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+        for input_zip in open_zips.values():
+            input_zip.close()
+        print_debug(stager.report())
+        instrumentation.start("patch")
+        pkgs_to_patch = sorted(pkg for pkg in wanted if pkg not in unchanged and os.path.exists(os.path.join("khbuild", pkg)))
+        failed = []
+        patchpool = pool or ThreadPoolExecutor(max_workers=resolve_workers(args.workers, len(pkgs_to_patch)))
+        outdirs = {}
+        try:
+            #all made before the first IdxImg starts, so an unwritable game folder fails before anything is patched
+            for pkg in pkgs_to_patch:
+                outdirs[pkg] = patch_output_dir(PKGDIR, pkg)
+            futures = {}
+            for pkg in pkgs_to_patch:
+                print_debug("Patching: {}".format(pkg))
+                pkgfile = os.path.join(PKGDIR, pkg+".pkg")
+                futures[patchpool.submit(patch_pkg, IDXPATH, pkgfile, os.path.join("khbuild", pkg), outdirs[pkg], args.timeout)] = pkg
+            for future in as_completed(futures):
+                pkg = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    #keep going so the other pkgs still get installed, a failed pkg is left untouched in PKGDIR
+                    print(err)
+                    failed.append(pkg)
+                    continue
+                installstart = time.time()
+                #journaled before the first rename, so an interrupted install still gets restored next time
+                dirty[pkg] = None
+                save_game_state(STATE_JOURNAL_PATH, game.name, dirty)
+                with io_slots:
+                    copied = install_pkg(outdirs[pkg], PKGDIR, pkg)
+                instrumentation.add("install", time.time() - installstart, files=2, nbytes=copied)
+                game_manifest[pkg]["installed"] = dirty[pkg] = pkg_signature(PKGDIR, pkg)
+                save_game_state(STATE_JOURNAL_PATH, game.name, dirty)
+                print_debug("Patched: {}".format(pkg))
+        finally:
+            if pool is None:
+                patchpool.shutdown()
+            for outdir in outdirs.values():
+                shutil.rmtree(outdir, ignore_errors=True)
+        for pkg in failed:
+            del game_manifest[pkg]
+        save_game_state(BUILD_MANIFEST_PATH, game.name, game_manifest)
+        if failed:
+            raise Exception("Patch failed for: {}".format(", ".join(sorted(failed))))
         if not keepkhbuild:
-            shutil.rmtree("khbuild")
-    print_debug("All done! Took {}s".format(round(time.time()-starttime, 2)) + " | Mode: " + mode)
+            instrumentation.start("cleanup")
+            for pkg in pkgs_to_patch:
+                shutil.rmtree(os.path.join("khbuild", pkg))
+            if pool is None:
+                #in a batch the other games may still be staging into it, run_batch removes it once they're done
+                remove_empty_khbuild()
+    if restore and not patch:
+        save_game_state(BUILD_MANIFEST_PATH, game.name, game_manifest)
+    get_checksum_cache().save()
+
+class ModWatcher:
+    #waits for changes below a set of folders. uses watchdog's filesystem events when it's installed, otherwise polls
+    #the folders every `interval` seconds. wait() returns once no new change came in for `debounce` seconds, so a mods
+    #manager build that writes hundreds of files ends up as one repatch
+    def __init__(self, paths, debounce=1.0, interval=0.5):
+        self.paths = [p for p in paths if p and os.path.exists(p)]
+        self.debounce = debounce
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.event = threading.Event()
+        self.observer = None
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            self.state = self.poll()
+            return
+        watcher = self
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type in ["opened", "closed_no_write"]:
+                    return
+                #a folder's modified event only says one of its files changed, and that file has its own event.
+                #created, moved and deleted folders still count, those get walked or dropped as a whole
+                if event.is_directory and event.event_type == "modified":
+                    return
+                paths = [event.src_path] + ([event.dest_path] if getattr(event, "dest_path", "") else [])
+                watcher.notify(paths)
+        self.observer = Observer()
+        for path in self.paths:
+            self.observer.schedule(Handler(), path, recursive=True)
+        self.observer.start()
+    def notify(self, paths):
+        with self.lock:
+            self.changed.update(os.fsdecode(p) for p in paths)
+        self.event.set()
+    def poll(self):
+        state = {}
+        for path in self.paths:
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    fn = os.path.join(root, file)
+                    try:
+                        st = os.stat(fn)
+                    except OSError:
+                        continue
+                    state[fn] = (st.st_size, st.st_mtime_ns)
+        return state
+    def check(self):
+        #polling fallback, compares a fresh stat of every file with the last one
+        if self.observer is not None:
+            return
+        state = self.poll()
+        changed = [fn for fn in set(state) | set(self.state) if state.get(fn) != self.state.get(fn)]
+        self.state = state
+        if changed:
+            self.notify(changed)
+    def wait(self):
+        while not self.event.is_set():
+            self.check()
+            self.event.wait(self.interval)
+        #debounce: keep collecting until things stay quiet
+        while True:
+            self.event.clear()
+            time.sleep(self.debounce)
+            self.check()
+            if not self.event.is_set():
+                break
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return changed
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+def watch(args):
+    #patches once, then keeps the pkgmap index and the mod tree snapshot in memory and repatches whenever the mod folder
+    #or the extra patches change. the build manifest makes sure only the pkgs whose inputs changed get restored and
+    #rebuilt
+    if args.mode not in ["patch", "fast_patch"]:
+        raise Exception("-watch only works with the patch and fast_patch modes")
+    game, PKGDIR, MODDIR, IDXPATH = resolve_paths(args)
+    instrumentation.start("pkgmap_load")
+    pkgmap = PkgMapIndex.open(game.name)
+    snapshot = ModTreeSnapshot(MODDIR)
+    watcher = ModWatcher([MODDIR, args.patches_path], debounce=args.debounce)
+    print_debug("Watching {} for changes ({}), press Ctrl+C to stop".format(", ".join(watcher.paths), "watchdog" if watcher.observer is not None else "polling"))
+    try:
+        while True:
+            cyclestart = time.time()
+            try:
+                execute_plan(build_plan(args, pkgmap, snapshot), args)
+                print_debug("Patched in {}s, waiting for changes".format(round(time.time()-cyclestart, 2)))
+            except Exception as err:
+                #a half written mod shouldn't end the session, the next change gets another try
+                print_debug("Patch failed: {}".format(err))
+            changed = watcher.wait()
+            print_debug("{} changed path(s), repatching".format(len(changed)))
+            instrumentation.start("mod_snapshot")
+            snapshot.update(sorted(p for p in changed if p == MODDIR or p.startswith(MODDIR + os.sep)))
+    except KeyboardInterrupt:
+        print_debug("Stopped watching")
+    finally:
+        watcher.stop()
+        pkgmap.close()
+
+def remove_empty_khbuild():
+    try:
+        os.rmdir("khbuild")
+    except OSError:
+        pass
+
+def run_batch(args):
+    #runs one mode for several games. the pkgmap index, the mod tree snapshot, the backup store and the worker pool are
+    #set up once and shared, every game executes on its own thread and their disk heavy work is limited by io_slots
+    gamenames = list(games.keys()) if args.games == "all" else [g.strip() for g in args.games.split(",") if g.strip()]
+    for gamename in gamenames:
+        if gamename not in games:
+            raise Exception("Game not found, possible options: {}".format(list(games.keys())))
+    if args.watch:
+        raise Exception("-watch only works on a single game")
+    instrumentation.start("batch_setup")
+    snapshot = None
+    if args.mode in ["patch", "fast_patch", "analyze"]:
+        snapshot = ModTreeSnapshot(os.path.join(args.openkh_path, "mod"))
+    backup_store = BackupStore()
+    if os.path.exists("backup_pkgs"):
+        backup_store.import_legacy("backup_pkgs")
+    plans = []
+    for gamename in gamenames:
+        gameargs = argparse.Namespace(**vars(args))
+        gameargs.game = gamename
+        pkgmap = PkgMapIndex.open(games[gamename](region=args.region).name)
+        instrumentation.local.prefix = gamename + " "
+        try:
+            plans.append((build_plan(gameargs, pkgmap, snapshot), gameargs))
+        finally:
+            pkgmap.close()
+            instrumentation.local.prefix = ""
+    instrumentation.end()
+    errors = {}
+    def run(plan, gameargs):
+        instrumentation.local.prefix = gameargs.game + " "
+        try:
+            execute_plan(plan, gameargs, pool, backup_store)
+        except Exception as err:
+            print_debug("{} failed: {}".format(gameargs.game, err))
+            errors[gameargs.game] = str(err)
+        finally:
+            instrumentation.end()
+    pool = ThreadPoolExecutor(max_workers=resolve_workers(args.workers, sum(len(games[g](region=args.region).pkgs) for g in gamenames)))
+    try:
+        threads = [threading.Thread(target=run, args=planargs) for planargs in plans]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.shutdown()
+    if args.mode in ["patch", "fast_patch"] and not args.keepkhbuild:
+        remove_empty_khbuild()
+    if errors:
+        raise Exception("Batch failed for: {}".format(", ".join(sorted(errors))))
+
+def main_ui():
+    #gooey is only imported for the gui, the cmd path and library users never pay for it
+    from gooey import Gooey
+    Gooey(program_name="Mod Manager Bridge")(main)(gui=True)
+
+def main(cli_args: list = [], gui=False):
+    global instrumentation
+    starttime = time.time()
+    instrumentation = Instrumentation()
+    instrumentation.start("config")
+
+    args = parse_args(cli_args, gui)
+
+    config_to_write = {
+        "game": args.game,
+        "mode": args.mode,
+        "openkh_path": args.openkh_path,
+        "extracted_games_path": args.extracted_games_path,
+        "khgame_path": args.khgame_path,
+        "region": args.region,
+        "patches_path": args.patches_path,
+    }
+    json.dump(config_to_write, open("config.json", "w"))
+
+    if args.report:
+        instrumentation = Instrumentation(enabled=True)
+        instrumentation.starttime = starttime
+        instrumentation.start("config")
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    global io_slots
+    io_slots = IOSlots(args.iolimit if args.iolimit is not None else BATCH_IOLIMIT if args.games else 0)
+    idximg_cancelled.clear()
+    #ctrl+c also stops the IdxImg processes the worker threads are waiting on
+    old_handler = None
+    if threading.current_thread() is threading.main_thread():
+        old_handler = signal.signal(signal.SIGINT, cancel_idximg)
+    try:
+        if args.games:
+            run_batch(args)
+        elif args.watch:
+            watch(args)
+        else:
+            instrumentation.start("plan")
+            if args.mode not in ["patch", "fast_patch", "analyze"]:
+                #nothing to plan, so don't walk the mod folder for a cache key either
+                plan = PatchPlan(args.game, args.region, args.mode)
+            elif args.noplancache:
+                plan = build_plan(args)
+            else:
+                plan = load_plan(args)
+            execute_plan(plan, args)
+    finally:
+        if old_handler is not None:
+            signal.signal(signal.SIGINT, old_handler)
+
+    instrumentation.end()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.report:
+        save_state(args.report, instrumentation.report(game=args.game, mode=args.mode, timestamp=starttime))
+    print_debug("Phases: " + instrumentation.summary(), verbose=True)
+    print_debug("All done! Took {}s".format(round(time.time()-starttime, 2)) + " | Mode: " + args.mode)
 
 if __name__ == "__main__":
     import sys
     if "cmd" in sys.argv:
+        sys.argv.remove("cmd")
         main()
     else:
         main_ui()
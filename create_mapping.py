@@ -1,28 +1,103 @@
-import json, os
-
-x = {}
-
-x_r = {}
-
-for root, dirs, files in os.walk("extracted_pkgs"):
-    #if "remastered" in root:
-    #    continue
-    path = root.split(os.sep)
-    if not len(path) > 1:
-        print("skipping {}".format(path))
-        continue
-    pkg = path[1]
-    game = pkg.split("_")[0]
-    if not game in x:
-        x[game] = {}
-    for file in files:
-        if path[2] == "remastered":
-            relpath = os.path.join(*path[2:],file)
-        else:
-            relpath = os.path.join(*path[3:],file)
-        #relpath = os.path.join(*path[2:],file)
-        if relpath not in x[game]:
-            x[game][relpath] = []
-        x[game][relpath].append(pkg)
-
-json.dump(x, open("pkgmap.json", "w"))
+import json, os, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Generates pkgmap.json from the output of `hed extract` for every pkg, laid out as extracted_pkgs/<pkg>/original|remastered/...
+# Every pkg directory is scanned on its own thread, and pkgs whose file sizes and mtimes didn't change since the last run
+# are taken from pkgmap_cache.json without being rescanned. Files that did change are only rehashed when their size or
+# mtime differ from the cache. pkgmap_files.json records the size and md5 of every entry for other tools.
+
+EXTRACTED_PKGS = "extracted_pkgs"
+CACHE_PATH = "pkgmap_cache.json"
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+def md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def dir_signature(pkgdir):
+    #size and mtime of every file in the pkg. re-extracting over an existing folder rewrites files in place without
+    #touching the directory mtimes, so those alone aren't enough. still no reads, only the stats os.scandir hands out
+    sig = hashlib.md5()
+    stack = [pkgdir]
+    while stack:
+        d = stack.pop()
+        entries = sorted(os.scandir(d), key=lambda e: e.name)
+        for e in entries:
+            if e.is_file():
+                st = e.stat()
+                sig.update("{}:{}:{}\n".format(os.path.relpath(e.path, pkgdir), st.st_size, st.st_mtime_ns).encode("utf-8"))
+        stack += [e.path for e in entries if e.is_dir()]
+    return sig.hexdigest()
+
+def scan_pkg(pkg, cached):
+    pkgdir = os.path.join(EXTRACTED_PKGS, pkg)
+    signature = dir_signature(pkgdir)
+    if cached and cached["signature"] == signature:
+        return cached, False
+    old_entries = cached["entries"] if cached else {}
+    entries = {}
+    for root, dirs, files in os.walk(pkgdir):
+        path = os.path.relpath(root, pkgdir).split(os.sep)
+        if path == ["."]:
+            if files:
+                print("skipping {} files directly in {}".format(len(files), pkgdir))
+            continue
+        for file in files:
+            #remastered paths keep their folder, original paths are relative to the original folder
+            if path[0] == "remastered":
+                relpath = os.path.join(*path, file)
+            else:
+                relpath = os.path.join(*path[1:], file)
+            fn = os.path.join(root, file)
+            st = os.stat(fn)
+            old = old_entries.get(relpath)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                entries[relpath] = old
+            else:
+                entries[relpath] = [st.st_size, st.st_mtime_ns, md5_file(fn)]
+    return {"signature": signature, "entries": entries}, True
+
+def save_json(data, path):
+    tmpfn = path + ".tmp"
+    with open(tmpfn, "w") as f:
+        json.dump(data, f)
+    os.replace(tmpfn, path)
+
+def main():
+    cache = {}
+    if os.path.exists(CACHE_PATH):
+        try:
+            cache = json.load(open(CACHE_PATH))
+        except ValueError:
+            print("{} is corrupt, rescanning everything".format(CACHE_PATH))
+    pkgs = sorted(p for p in os.listdir(EXTRACTED_PKGS) if os.path.isdir(os.path.join(EXTRACTED_PKGS, p)))
+    with ThreadPoolExecutor() as pool:
+        results = list(pool.map(lambda pkg: scan_pkg(pkg, cache.get(pkg)), pkgs))
+    rescanned = [pkg for pkg, (_, changed) in zip(pkgs, results) if changed]
+    print("rescanned {} of {} pkgs {}".format(len(rescanned), len(pkgs), rescanned))
+    if not rescanned and set(cache) == set(pkgs) and os.path.exists("pkgmap.json"):
+        return
+    cache = {pkg: scanned for pkg, (scanned, _) in zip(pkgs, results)}
+
+    x = {}
+    x_files = {}
+    for pkg in pkgs:
+        game = pkg.split("_")[0]
+        if not game in x:
+            x[game] = {}
+        x_files[pkg] = {}
+        for relpath, (size, mtime_ns, md5) in sorted(cache[pkg]["entries"].items()):
+            if relpath not in x[game]:
+                x[game][relpath] = []
+            x[game][relpath].append(pkg)
+            x_files[pkg][relpath] = [size, md5]
+
+    save_json(x, "pkgmap.json")
+    save_json(x_files, "pkgmap_files.json")
+    save_json(cache, CACHE_PATH)
+
+if __name__ == "__main__":
+    main()